@@ -10,8 +10,16 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import file_utils as fu
 import utils as u
+import queries as q
+from interval_index import ChromIntervals, IntervalIndex, SweepIndex, \
+    UnsortedInputError
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -93,6 +101,51 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+"""Returns the lookup structure for the selected engine: an in-memory
+   interval index ('index'), a sweep-line merge-join over sorted input on
+   its own pooled connection ('sweep'), or None when the stage should
+   query MySQL per variant ('sql'). The sweep returns rows in primary key
+   order, so a table without a primary key gets the interval index.
+"""
+def getOverlapIndex(cursor, table, engine='sql', **kwargs):
+    if (engine == 'sweep'):
+        if (kwargs.get('chrom_col', 'chrom') is None):
+            # Split per chromosome, the key is looked up per table
+            return SweepIndex(u.get_connection_manager().acquire(), table, 
+                **kwargs)
+        key = q.primaryKey(cursor, table)
+        if (key is not None):
+            return SweepIndex(u.get_connection_manager().acquire(), table, 
+                key=key, **kwargs)
+        print(f"{table} has no primary key, using the interval index " + \
+            "instead of the sweep")
+        engine = 'index'
+    if (engine == 'index'):
+        return IntervalIndex(cursor, table, **kwargs)
+    return None
+
+
+"""Interval index over cpgIslandExt for the promoter checks of the genes
+   stage and getExonsEtAl: loaded once per chromosome, so a variant in a
+   promoter window costs no extra queries. first() returns the row the
+   per-variant query would fetch first.
+"""
+def getCpgIslandIndex(cursor):
+    return IntervalIndex(cursor, 'cpgIslandExt', chrom_col='chrom', 
+        start_col='chromStart', end_col='chromEnd', 
+        columns='chrom, chromStart, chromEnd, name')
+
+
+"""' AND bin IN (...)' narrowing a query for rows overlapping [start, end]
+   to the UCSC bins that can hold them, or '' if the table has no bin
+   column
+"""
+def binClause(cursor, table, start, end):
+    if q.hasBinColumn(cursor, table):
+        return ' AND ' + u.binPredicate(start, end)
+    return ''
+
+
 def getComplementary(nuc):
     compNuc = ''
     if (str(nuc) == 'A'):
@@ -107,398 +160,909 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Per-variant dbSNP lookup, one round trip per record
+   sql is the DBSNP statement prepared with the columns the caller reads
+"""
+def fetchDbSnp(cursor, record, varclass='SNV', sql=None):
+    if (sql is None):
+        sql = q.prepare(q.DBSNP, columns='*')
+    cursor.execute(sql, (record.chrom, record.pos, record.ref, 
+        record.compRef, varclass))
+    return cursor.fetchall()
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+"""dbSNP lookup against a reference snapshot (no database round trip)
+   The index must be opened with the REF and INFO columns first; the rows
+   returned hold the remaining columns.
+"""
+def fetchDbSnpSnapshot(index, record, varclass='SNV'):
+    return [row[2:] for row in index.overlapping(record.chrom, record.pos) 
+        if str(row[0]).upper() in record.refKeys and 
+        str(row[1]) == varclass]
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+"""Set-based dbSNP lookup for a block of records
+   Issues one query per chromosome in the block and returns the matching
+   rows for every record (same order as the records) plus the number of
+   queries sent to the database. sql is the DBSNP_BLOCK statement prepared
+   with the columns the caller reads.
+"""
+def fetchDbSnpBlock(cursor, records, varclass='SNV', sql=None):
+    if (sql is None):
+        sql = q.prepare(q.DBSNP_BLOCK, columns='*')
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+    by_chrom = {}
+    for record in records:
+        by_chrom.setdefault(record.chrom, set()).add(record.pos)
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+    found = {}
+    queries = 0
+    for chr, positions in by_chrom.items():
+        positions = sorted(positions)
+        cursor.execute(sql.replace('{positions}', 
+            ','.join(['%s'] * len(positions))), [chr, varclass] + positions)
+        queries = queries + 1
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+        for row in cursor.fetchall():
+            found.setdefault((chr, int(row[0])), []).append(row)
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    hits = []
+    for record in records:
+        hits.append([row[2:] for row in 
+            found.get((record.chrom, record.pos), []) 
+            if str(row[1]).upper() in record.refKeys])
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    return hits, queries
 
-            linenum = linenum + 1
 
+"""Header, comment and blank lines are passed through by every stage
+"""
+def isHeader(line):
+    return (line.startswith('#') or line.startswith('CHROM') or 
+        len(line) == 0)
+
+
+"""One record on its way through the stages
+   The chromosome (without 'chr' as in dbSNP, and with it as in the UCSC
+   tables), the position and the alleles with their complements are parsed
+   once when the record is read. refKeys are the alleles dbSNP's REF is
+   matched against and haplotypes the (reference, alternate) pairs of the
+   chrom_pos_equal_base tier, in upper case, since MySQL compares them
+   without regard to case (the complement of a lower case allele is
+   empty, as it always was). Stages add INFO fragments to a list instead of rebuilding
+   the INFO string, and toFields() joins them once at the end.
+"""
+class VariantRecord(object):
+    __slots__ = ['fields', 'chrom', 'ucscChrom', 'pos', 'ref', 'alt', 
+        'compRef', 'compAlt', 'refKeys', 'haplotypes', 'info']
+
+    def __init__(self, fields, inds):
+        self.fields = fields
+        chr = fields[inds[0]].strip()
+        self.chrom = chr.replace('chr', '') if chr.startswith('chr') else chr
+        self.ucscChrom = chr if chr.startswith('chr') else 'chr' + chr
+        self.pos = int(fields[inds[1]].strip())
+        self.ref = fields[inds[2]].strip()
+        self.alt = fields[inds[3]].strip()
+        self.compRef = getComplementary(self.ref)
+        self.compAlt = getComplementary(self.alt)
+        self.refKeys = (self.ref.upper(), self.compRef)
+        self.haplotypes = [(self.ref.upper(), self.alt.upper()), 
+            (self.compRef, self.compAlt)]
+        self.info = [fields[7]]
+
+    """The INFO column as it stands
+    """
+    def getInfo(self):
+        if (len(self.info) > 1):
+            self.info = [''.join(self.info)]
+        return self.info[0]
+
+    def setInfo(self, text):
+        self.info = [text]
+
+    def infoStartsWith(self, prefix):
+        head = ''
+        for fragment in self.info:
+            head = head + fragment
+            if (len(head) >= len(prefix)):
+                break
+        return head.startswith(prefix)
+
+    def infoEndsWith(self, c):
+        for fragment in reversed(self.info):
+            if (len(fragment) > 0):
+                return fragment.endswith(c)
+        return False
+
+    """Appends text to INFO, after a ';' unless INFO already ends with one
+    """
+    def addInfo(self, text):
+        if self.infoEndsWith(';'):
+            self.info.append(text)
         else:
-            fh_out.write(line + '\n')
-
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+            self.info.append(';' + text)
+
+    """Prefixes every column but the first with a space (see GadAllStage)
+    """
+    def space(self):
+        self.fields = self.fields[:1] + [' ' + f for f in self.fields[1:]]
+        self.info.insert(0, ' ')
+
+    def toFields(self):
+        fields = list(self.fields)
+        fields[7] = self.getInfo()
+        return fields
+
+
+"""Base class for one annotation stage
+   fetch() resolves the reference rows for a block of records
+   (VariantRecords) and apply() annotates one record with its rows. Counters live on
+   the stage and are only written out by writeLog(), so the same stage can
+   run standalone over a file or fused with the others in a single pass.
+   If open() is given a reference snapshot the stage reads the rows from
+   it instead of the cursor. Stages only select the reference columns
+   listed in columns (their positions in the table), in that order.
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+class Stage(object):
+    name = ''
+    logmode = 'a'
+    rewrites = [7]    # record columns apply() may change
+    columns = None    # reference columns apply() reads (None = all)
+
+    def __init__(self, format='vcf', sep='\t'):
+        self.format = format
+        self.sep = sep
+        self.inds = getFormatSpecificIndices(format=format)
+        self.block_size = 1
+        self.cursor = None
+        self.snapshot = None
+        self.counts = {}
+
+    def open(self, cursor, snapshot=None):
+        self.cursor = cursor
+        self.snapshot = snapshot
+
+    def fetch(self, records):
+        return [self.lookup(record) for record in records]
+
+    def lookup(self, record):
+        return []
+
+    """Select list for the stage's columns of table
+    """
+    def projection(self, table):
+        if (self.columns is None):
+            return '*'
+        if (self.snapshot is not None):
+            names = self.snapshot.columns(table)
+        else:
+            names = q.tableColumns(self.cursor, table)
+        return q.projection(names, self.columns)
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+    def apply(self, record, rows):
+        pass
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+    def writeLog(self, fh_log):
+        pass
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def close(self):
+        pass
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+    """Identifies the stage and the settings that change its output (part
+       of the variant cache key)
+    """
+    def signature(self):
+        return type(self).__name__ + ':' + str(self.name)
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    """Adds counters collected by another copy of this stage (e.g. one
+       annotating a different shard of the same file)
+    """
+    def mergeCounts(self, counts):
+        for key in counts:
+            self.counts[key] = self.counts.get(key, 0) + counts[key]
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+"""Items annotateRecords() reads per block for the stages
+"""
+def blockSize(stages):
+    return max([stage.block_size for stage in stages] + [1])
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+"""Splits the stages (by index) into at most n lanes, round robin in
+   stage order; the stages of a lane share a cursor
+"""
+def fetchLanes(stages, n):
+    return [list(range(l, len(stages), n)) 
+        for l in range(0, max(1, min(n, len(stages))))]
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+"""Rows of a block of records for every stage, in stage order
+   Lanes fetch concurrently in the thread pool (their stages one after the
+   other); fetch() only reads the input columns of the records, so the
+   rows, and hence the output, are the same as when fetching serially.
+"""
+def fetchBlock(stages, records, lanes, pool=None):
+    if (pool is None):
+        return [stage.fetch(records) for stage in stages]
+
+    hits = [None] * len(stages)
+    def fetchLane(lane):
+        for s in lane:
+            hits[s] = stages[s].fetch(records)
+    for future in [pool.submit(fetchLane, lane) for lane in lanes]:
+        future.result()
+    return hits
+
+
+"""Streams records through the stages in a single pass
+   items are records (lists of fields) or lines; lines are stripped, and
+   header, comment and blank lines are passed through while the others
+   are split on sep. Items are read in blocks; each stage fetches the rows
+   for the whole block, then every record goes through the stages in order
+   in memory. Yields every item in input order: records as the annotated
+   lists of fields, passed-through lines as strings. With a reference
+   snapshot the cursor may be None. With a variant cache, records found in
+   it are rebuilt from the cache and never fetched. cursor may also be a
+   list of cursors on separate connections; the stages are then split
+   into that many lanes that fetch concurrently (see fetchBlock).
+"""
+def annotateRecords(items, stages, cursor, sep='\t', snapshot=None, 
+    cache=None, format='vcf'):
+    inds = getFormatSpecificIndices(format=format)
+    cursors = cursor if isinstance(cursor, list) else [cursor]
+    lanes = fetchLanes(stages, len(cursors))
+    for l in range(0, len(lanes)):
+        for s in lanes[l]:
+            stages[s].open(cursors[l], snapshot=snapshot)
+    block_size = blockSize(stages)
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=len(lanes)) \
+        if (len(lanes) > 1) else None
+
+    try:
+        while True:
+            block = []
+            for item in islice(items, block_size):
+                if isinstance(item, str):
+                    line = item.strip()
+                    block.append(line if isHeader(line) else line.split(sep))
+                else:
+                    block.append([str(f) for f in item])
+            if (len(block) == 0):
+                break
+
+            records = [item for item in block if not isinstance(item, str)]
+            keys = [None] * len(records)
+            cached = [None] * len(records)
+            if (cache is not None):
+                keys = [cache.key(fields) for fields in records]
+                cached = [cache.get(key) for key in keys]
+            misses = [VariantRecord(records[r], inds) 
+                for r in range(0, len(records)) if cached[r] is None]
+            hits = fetchBlock(stages, misses, lanes, pool)
+
+            rec = 0
+            miss = 0
+            for item in block:
+                if isinstance(item, str):
+                    yield item
+                    continue
+
+                fields = records[rec]
+                if (cached[rec] is not None):
+                    for s in range(0, len(stages)):
+                        stages[s].mergeCounts(cached[rec]['counts'][s])
+                    fields = cache.rebuild(fields, cached[rec])
+                elif (cache is not None):
+                    before = [dict(stage.counts) for stage in stages]
+                    for s in range(0, len(stages)):
+                        stages[s].apply(misses[miss], hits[s][miss])
+                    fields = misses[miss].toFields()
+                    cache.put(keys[rec], records[rec], fields, 
+                        [countsDelta(before[s], stages[s].counts) 
+                        for s in range(0, len(stages))])
+                    miss = miss + 1
+                else:
+                    for s in range(0, len(stages)):
+                        stages[s].apply(misses[miss], hits[s][miss])
+                    fields = misses[miss].toFields()
+                    miss = miss + 1
+                rec = rec + 1
+                yield fields
+
+            if (cache is not None):
+                cache.flush()
+    finally:
+        if (pool is not None):
+            pool.shutdown()
+        for stage in stages:
+            stage.close()
+
+
+"""annotateRecords() over lines, yielding the annotated lines (stripped,
+   without the newline)
+"""
+def annotateLines(lines, stages, cursor, sep='\t', snapshot=None, 
+    cache=None, format='vcf'):
+    for item in annotateRecords(lines, stages, cursor, sep=sep, 
+        snapshot=snapshot, cache=cache, format=format):
+        yield item if isinstance(item, str) else '\t'.join(item)
 
-            vcf_linenum = vcf_linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
+"""Counter increments between two snapshots of a stage's counts
+"""
+def countsDelta(before, after):
+    delta = {}
+    for key in after:
+        if (after[key] != before.get(key, 0)):
+            delta[key] = after[key] - before.get(key, 0)
+    return delta
+
+
+"""Runs a single stage over vcf + tmpextin and writes vcf + tmpextout
+   The stage counters go to the .count.log next to the vcf. Uses conn if
+   given, otherwise borrows a connection from the pool (unless the rows
+   come from a reference snapshot).
+"""
+def runStage(stage, vcf, tmpextin='', tmpextout='.1', conn=None, 
+    snapshot=None):
+    if (conn is None and snapshot is None):
+        with u.pooled_connection() as conn:
+            return runStage(stage, vcf, tmpextin=tmpextin, 
+                tmpextout=tmpextout, conn=conn)
+
+    fh = open(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+
+    cursor = conn.cursor() if (conn is not None) else None
+    for line in annotateLines(fh, [stage], cursor, sep=stage.sep, 
+        snapshot=snapshot, format=stage.format):
+        fh_out.write(line + '\n')
+
+    fh_log = open(vcf + '.count.log', stage.logmode)
+    stage.writeLog(fh_log)
+    fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
 
-"""Get information about location in gene structures
-"""
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    If batch_size > 0 variants are resolved in blocks of batch_size records
+    with set-based queries instead of one query per variant
+    With a dbsnp_filter.DbSnpFilter, variants it rules out are not looked
+    up at all
+""" 
+class DbSnpStage(Stage):
+    name = 'dbSNP'
+    logmode = 'w'
+    rewrites = [2, 7]
+    columns = [3, 7]    # rsid, GMAF
+
+    def __init__(self, varclass='SNV', batch_size=0, dbsnp_filter=None, 
+        format='vcf', sep='\t'):
+        Stage.__init__(self, format=format, sep=sep)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.block_size = max(batch_size, 1)
+        self.dbsnp_filter = dbsnp_filter
+        self.counts = dict.fromkeys(['variants', 'var_count', 'queries',
+            'screened'], 0)
+
+    def open(self, cursor, snapshot=None):
+        Stage.open(self, cursor, snapshot=snapshot)
+        self.index = None
+        columns = self.projection('dbSNP')
+        if (snapshot is not None):
+            self.index = snapshot.index('dbSNP', 
+                columns='REF, INFO, ' + columns)
+        else:
+            self.sql = q.prepare(q.DBSNP, columns=columns)
+            self.block_sql = q.prepare(q.DBSNP_BLOCK, columns=columns)
+
+    def signature(self):
+        return Stage.signature(self) + ':' + self.varclass
+
+    """One flag per record: False if the filter rules the variant out
+    """
+    def screen(self, records):
+        by_chrom = {}
+        for r in range(0, len(records)):
+            by_chrom.setdefault(records[r].chrom, []).append(r)
+
+        keep = [True] * len(records)
+        for chr, rs in by_chrom.items():
+            flags = self.dbsnp_filter.mightContain(chr, 
+                [records[r].pos for r in rs], self.varclass)
+            for i in range(0, len(rs)):
+                keep[rs[i]] = bool(flags[i])
+        return keep
+
+    def fetch(self, records):
+        if (self.index is not None):
+            return [fetchDbSnpSnapshot(self.index, record, 
+                varclass=self.varclass) for record in records]
+        if (self.dbsnp_filter is not None):
+            keep = self.screen(records)
+            hits = iter(self.query([records[r] 
+                for r in range(0, len(records)) if keep[r]]))
+            self.counts['screened'] += keep.count(False)
+            return [next(hits) if keep[r] else [] 
+                for r in range(0, len(records))]
+        return self.query(records)
+
+    def query(self, records):
+        if (len(records) == 0):
+            return []
+        if (self.batch_size > 0):
+            hits, queries = fetchDbSnpBlock(self.cursor, records, 
+                varclass=self.varclass, sql=self.block_sql)
+        else:
+            hits = [fetchDbSnp(self.cursor, record, varclass=self.varclass, 
+                sql=self.sql) for record in records]
+            queries = len(records)
+        self.counts['queries'] += queries
+        return hits
+
+    def apply(self, record, rows):
+        self.counts['variants'] += 1
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        record.fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[0]))
+                if (str(row[1]) != '.'):
+                    mafs.append('GMAF=' + str(row[1]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.counts['var_count'] += 1
+            if (record.getInfo() == '.'):
+                record.setInfo('DB' + maf_str)
+            else:
+                record.info.append(';DB;VC=' + self.varclass + maf_str)
+
+            record.fields[2] = str(';'.join(rsids))
+
+    def writeLog(self, fh_log):
+        linenum = self.counts['variants'] + 1
+        var_count = self.counts['var_count']
+        queries = self.counts['queries']
+
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+        if (self.batch_size > 0):
+            fh_log.write(f"dbSNP lookups: {str(queries)} queries for " + \
+                f"{str(linenum - 1)} variants " + \
+                f"({str(linenum - 1 - queries)} round trips saved)\n")
+        if (self.dbsnp_filter is not None):
+            fh_log.write(f"dbSNP filter: {str(self.counts['screened'])} " + \
+                f"of {str(linenum - 1)} variants ruled out without a " + \
+                "lookup\n")
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=0, dbsnp_filter=None, conn=None):
+    runStage(DbSnpStage(varclass=varclass, batch_size=batch_size, 
+        dbsnp_filter=dbsnp_filter, format=format, sep=sep), vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, conn=conn)
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+bigRefGeneTables = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase', 
+    'chrom_pos_unequal']
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+"""Merges sorted positions into [lo, hi] ranges, starting a new range
+   when the next position is more than gap away
+"""
+def positionRanges(positions, gap=1000):
+    ranges = []
+    for pos in positions:
+        if (len(ranges) > 0 and pos - ranges[-1][1] <= gap):
+            ranges[-1][1] = pos
+        else:
+            ranges.append([pos, pos])
+    return ranges
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
+"""bigRefGene lookup for a block of records in a single request
+   All three tiers of every chromosome in the block are fetched with one
+   UNION ALL query; the precedence rules (equal_base with matching
+   haplotypes, else equal_nobase, else the unequal ranges containing the
+   position) are then applied per record in Python. Returns the rows for
+   every record, in the same order as the records.
+"""
+def fetchBigRefGeneBlock(cursor, records):
+    by_chrom = {}
+    for record in records:
+        by_chrom.setdefault(record.chrom, set()).add(record.pos)
+    if (len(by_chrom) == 0):
+        return []
+
+    parts = []
+    args = []
+    for chr, positions in by_chrom.items():
+        positions = sorted(positions)
+        inlist = ','.join(['%s'] * len(positions))
+        for tier in [0, 1]:
+            parts.append('select ' + str(tier) + ' as tier, t.* from ' + \
+                bigRefGeneTables[tier] + ' t where CHR=%s AND start IN (' + \
+                inlist + ')')
+            args = args + [chr] + positions
+
+        ranges = positionRanges(positions)
+        parts.append('select 2 as tier, t.* from ' + bigRefGeneTables[2] + \
+            ' t where CHR=%s AND (' + \
+            ' OR '.join(['(start <= %s AND end >= %s)'] * len(ranges)) + ')')
+        args = args + [chr]
+        for lo, hi in ranges:
+            args = args + [hi, lo]
+
+    cursor.execute(' union all '.join(parts) + ';', args)
+    cols = [str(d[0]).lower() for d in cursor.description]
+    chr_ind = cols.index('chr')
+    start_ind = cols.index('start')
+    end_ind = cols.index('end')
+    hapRef = cols.index('haplotypereference')
+    hapAlt = cols.index('haplotypealternate')
+
+    equal = {}
+    unequal = {}
+    for row in cursor.fetchall():
+        if (row[0] == 2):
+            unequal.setdefault(str(row[chr_ind]), []).append(row)
+        else:
+            equal.setdefault((row[0], str(row[chr_ind]), 
+                int(row[start_ind])), []).append(row)
+
+    ranges = {}
+    for chr, rows in unequal.items():
+        ranges[chr] = ChromIntervals(rows, 
+            np.array([int(r[start_ind]) for r in rows], dtype=np.int64), 
+            np.array([int(r[end_ind]) for r in rows], dtype=np.int64))
+
+    hits = []
+    for record in records:
+        chr = record.chrom
+        pos = record.pos
+        rows = [row for row in equal.get((0, chr, pos), []) 
+            if (str(row[hapRef]).upper(), str(row[hapAlt]).upper()) in 
+            record.haplotypes]
+        if (len(rows) == 0):
+            rows = equal.get((1, chr, pos), [])
+        if (len(rows) == 0 and chr in ranges):
+            rows = [ranges[chr].rows[i] for i in ranges[chr].overlapping(pos)]
+        hits.append([row[1:] for row in rows])
+
+    return hits
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
 
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+    All three tiers are resolved in one request, per variant or (with
+    batch_size > 0) per block of batch_size variants
+"""
+class BigRefGeneStage(Stage):
+    name = 'BigRefGene'
+    tables = bigRefGeneTables
+
+    def __init__(self, batch_size=0, format='vcf', sep='\t'):
+        Stage.__init__(self, format=format, sep=sep)
+        self.batch_size = batch_size
+        self.block_size = max(batch_size, 1)
+
+    def open(self, cursor, snapshot=None):
+        Stage.open(self, cursor, snapshot=snapshot)
+        self.tiers = None
+        if (snapshot is not None):
+            self.tiers = [snapshot.index(t) for t in self.tables]
+
+    """Same three tiers as the queries below, read from the snapshot
+    """
+    def lookupSnapshot(self, chr, pos, haplotypes):
+        base = self.tiers[0]
+        hapRef = base.names.index('haplotypeReference')
+        hapAlt = base.names.index('haplotypeAlternate')
+        rows = [row for row in base.overlapping(chr, pos) 
+            if (str(row[hapRef]).upper(), str(row[hapAlt]).upper()) in 
+            haplotypes]
+        if (len(rows) > 0):
+            return rows
+
+        for index in self.tiers[1:]:
+            rows = index.overlapping(chr, pos)
+            if (len(rows) > 0):
+                return rows
+        return []
 
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
+    def lookup(self, record):
+        if (self.tiers is not None):
+            return self.lookupSnapshot(record.chrom, record.pos, 
+                record.haplotypes)
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+        return fetchBigRefGeneBlock(self.cursor, [record])[0]
 
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+    def fetch(self, records):
+        if (self.tiers is None and self.batch_size > 0):
+            return fetchBigRefGeneBlock(self.cursor, records)
+        return Stage.fetch(self, records)
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            # Deduplicate in row order (not via a set) so the output does
+            # not depend on the interpreter's hash seed
+            m = u.dedup([collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]]))
+                for row in rows])
 
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+            record.info.append(';' + ';'.join(m))
+            if record.infoStartsWith(".;"):
+                record.setInfo(record.getInfo().replace('.;', '', 1))
 
-                    else:
-                        region = ''
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    batch_size=0, conn=None):
+    runStage(BigRefGeneStage(batch_size=batch_size, format=format, sep=sep), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+"""Exon structure of one refGene transcript, parsed once from the row
+   Exon starts are sorted, so the exons containing a position are found
+   with a binary search (walking back over the running maximum of the exon
+   ends in case exons touch or overlap).
+"""
+class TranscriptModel(object):
+    def __init__(self, txStart, txEnd, cdsStart, cdsEnd, exonCount, 
+        exonStarts, exonEnds, strand):
+        self.txStart = int(txStart)
+        self.txEnd = int(txEnd)
+        self.cdsStart = int(cdsStart)
+        self.cdsEnd = int(cdsEnd)
+        self.exonCount = int(exonCount)
+        self.strand = str(strand)
+
+        starts = str(exonStarts.decode("utf-8")).split(',')
+        ends = str(exonEnds.decode("utf-8")).split(',')
+        self.starts = [int(starts[e]) for e in range(0, self.exonCount)]
+        self.ends = [int(ends[e]) for e in range(0, self.exonCount)]
+        self.maxends = []
+        for end in self.ends:
+            self.maxends.append(max(end, self.maxends[-1]) if 
+                (len(self.maxends) > 0) else end)
+
+    """Exons containing pos as 'ex<number>/<count>', numbered along the
+       strand, in genomic order
+    """
+    def exons(self, pos):
+        found = []
+        e = bisect_right(self.starts, pos) - 1
+        while (e >= 0 and self.maxends[e] >= pos):
+            if (self.ends[e] >= pos):
+                found.append(e)
+            e = e - 1
+
+        labels = []
+        for e in reversed(found):
+            exnum = e + 1
+            if (self.strand == '-'):
+                exnum = self.exonCount - e
+            labels.append('ex' + str(exnum) + '/' + str(self.exonCount))
+        return labels
+
+
+"""Transcript models are memoized for the life of the process, keyed by
+   the refGene columns they are built from
+"""
+@lru_cache(maxsize=65536)
+def getTranscriptModel(txStart, txEnd, cdsStart, cdsEnd, exonCount, 
+    exonStarts, exonEnds, strand):
+    return TranscriptModel(txStart, txEnd, cdsStart, cdsEnd, exonCount, 
+        exonStarts, exonEnds, strand)
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+"""Get information about location in gene structures
+"""
+class GenesStage(Stage):
+    name = 'Genes'
+    # positionType (from BigRefGene) -> counter
+    locations = {'intron': 'intronic_count', 
+        'non_coding_intron': 'non_coding_intronic_count', 'CDS': 'cds_count',
+        'non_coding_exon': 'non_coding_exonic_count', 'utr5': 'utr5_count',
+        'utr3': 'utr3_count'}
+    # bin .. name2; cdsStartStat, cdsEndStat and exonFrames are not read
+    columns = list(range(0, 13))
+
+    def __init__(self, table='refGene', promoter_offset=500, format='vcf', 
+        sep='\t'):
+        Stage.__init__(self, format=format, sep=sep)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.counts = dict.fromkeys(['interGenic_count', 'cds_count', 
+            'utr3_count', 'utr5_count', 'intronic_count', 
+            'non_coding_intronic_count', 'exonic_count', 
+            'non_coding_exonic_count', 'promoter_count'], 0)
+
+    def open(self, cursor, snapshot=None):
+        Stage.open(self, cursor, snapshot=snapshot)
+        self.genes = None
+        columns = self.projection(self.table)
+        if (snapshot is not None):
+            self.genes = snapshot.index(self.table, columns=columns)
+            self.cpg = snapshot.index('cpgIslandExt', 
+                columns='chrom, chromStart, chromEnd, name')
+        else:
+            self.sql = q.prepare(q.GENES, columns=columns, table=self.table)
+            self.cpg = getCpgIslandIndex(cursor)
+
+    def close(self):
+        self.cpg.close()
+
+    def signature(self):
+        return Stage.signature(self) + ':' + self.table + ':' + \
+            str(self.promoter_offset)
+
+    def lookup(self, record):
+        start = record.pos - int(self.promoter_offset)
+        end = record.pos + int(self.promoter_offset)
+
+        if (self.genes is not None):
+            return self.genes.overlapping(record.ucscChrom, start, end)
+
+        q.executeBinned(self.cursor, self.sql, self.table, 
+            (record.ucscChrom, end, start), start, end)
+        return self.cursor.fetchall()
+
+    def fetch(self, records):
+        return self.classify(records, 
+            [self.lookup(record) for record in records])
+
+    """Where each variant falls in each of its transcripts, for the whole
+       block at once with the batch interval helpers: 'non_coding', 'cds',
+       'promoter' (window only, the CpG island is checked in apply) or
+       None, tested in the order apply() used to. Returns the rows of each
+       record as (row, transcript model, region) triples.
+    """
+    def classify(self, records, hits):
+        flat = []
+        positions = []
+        for r in range(0, len(records)):
+            for row in hits[r]:
+                flat.append(getTranscriptModel(row[4], row[5], row[6], 
+                    row[7], row[8], row[9], row[10], row[3]))
+                positions.append(records[r].pos)
+        if (len(flat) == 0):
+            return hits
+
+        pos = np.array(positions, dtype=np.int64)
+        txStart = np.array([tx.txStart for tx in flat], dtype=np.int64)
+        txEnd = np.array([tx.txEnd for tx in flat], dtype=np.int64)
+        cdsStart = np.array([tx.cdsStart for tx in flat], dtype=np.int64)
+        cdsEnd = np.array([tx.cdsEnd for tx in flat], dtype=np.int64)
+        plus = np.array([tx.strand == "+" for tx in flat])
+        minus = np.array([tx.strand == "-" for tx in flat])
+        offset = int(self.promoter_offset)
+
+        nonCoding = (cdsStart == cdsEnd)
+        inCds = ~nonCoding & u.isBetweenBatch(pos, cdsStart, cdsEnd)
+        promoter = ~nonCoding & ~inCds & (
+            (u.isBetweenBatch(pos, txStart - offset, txStart) & plus) |
+            (u.isBetweenBatch(pos, txEnd, txEnd + offset) & minus))
+        regions = np.select([nonCoding, inCds, promoter], 
+            ['non_coding', 'cds', 'promoter'], '').tolist()
+
+        classified = []
+        i = 0
+        for rows in hits:
+            classified.append([(rows[j], flat[i + j], regions[i + j]) 
+                for j in range(0, len(rows))])
+            i = i + len(rows)
+        return classified
+
+    """First CpG island containing pos (chrom, chromStart, chromEnd, name)
+    """
+    def cpgIsland(self, chr, pos):
+        return self.cpg.first(chr, pos)
+
+    def apply(self, record, rows):
+        counts = self.counts
+        chr = record.ucscChrom
+        pos = record.pos
+        info = []
+
+        if (len(rows) > 0):
+            #count location (once per overlapping transcript)
+            positionType = str(u.parse_field(record.getInfo(), 
+                'positionType', ';', '='))
+            location = self.locations.get(positionType)
+
+            cnt = 1
+            for row, tx, kind in rows:
+                if (location is not None):
+                    counts[location] += 1
+
+                region = ""
+
+                if (kind == 'non_coding'):
+                    exons = ["non_coding_exon=" + ex for ex in tx.exons(pos)]
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (kind == 'cds'):
+                    exons = ["exon=" + ex for ex in tx.exons(pos)]
+                    counts['exonic_count'] += len(exons)
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (kind == 'promoter'):
+                    cpg = self.cpgIsland(chr, pos)
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(cpg[3]).split())
+                        counts['promoter_count'] += 1
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            record.info.append(';' + str_info)
 
         else:
-            fh_out.write(line + '\n')
+            record.info.append(";positionType=interGenic")
+            counts['interGenic_count'] += 1
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    def writeLog(self, fh_log):
+        counts = self.counts
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In interGenic {str(counts['interGenic_count'])}")
+        fh_log.write(f"In interGenic {str(counts['interGenic_count'])}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In CDS {str(counts['cds_count'])}")
+        fh_log.write(f"In CDS {str(counts['cds_count'])}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In \'3 UTR {str(counts['utr3_count'])}")
+        fh_log.write(f"In \'3 UTR {str(counts['utr3_count'])}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In \'5 UTR {str(counts['utr5_count'])}")
+        fh_log.write(f"In \'5 UTR {str(counts['utr5_count'])}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In Intronic {str(counts['intronic_count'])}")
+        fh_log.write(f"In Intronic {str(counts['intronic_count'])}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}")
+        fh_log.write(f"In Non_coding_intronic {str(counts['non_coding_intronic_count'])}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Exonic {str(counts['exonic_count'])}")
+        fh_log.write(f"In Exonic {str(counts['exonic_count'])}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}")
+        fh_log.write(f"In Non_coding_exonic {str(counts['non_coding_exonic_count'])}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Putative Promoter Region {str(counts['promoter_count'])}")
+        fh_log.write(f"In Putative Promoter Region {str(counts['promoter_count'])}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', conn=None):
+    runStage(GenesStage(table=table, promoter_offset=promoter_offset, 
+        format=format, sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -528,6 +1092,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    cpgIslands = getCpgIslandIndex(cursor)
     linenum = 1
 
     for line in fh:
@@ -548,7 +1113,9 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
                 '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+                str(promoter_offset) +')' + binClause(cursor, table, 
+                int(pos) - int(promoter_offset), 
+                int(pos) + int(promoter_offset)) + ';'
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
@@ -610,12 +1177,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = 'positionType=utr5'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
+                        (cdsStart < cdsEnd) and (strand == "+")):
                         utr3_count = utr3_count + 1
                         region = 'positionType=utr3'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
+                        (cdsStart < cdsEnd) and (strand == "-")):
                         utr5_count = utr5_count + 1
                         region = 'positionType=utr5'
 
@@ -626,12 +1193,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslands.first(chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -640,12 +1202,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslands.first(chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -712,400 +1269,287 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""Base class for the stages that look up the reference intervals a
+   variant falls in (chromStart <= pos <= chromEnd). With engine='index'
+   the rows come from an in-memory interval index instead of one query
+   per variant; a reference snapshot, when given, takes precedence over
+   the engine.
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class OverlapStage(Stage):
+    first_only = False
+    chrom_col = 'chrom'
+    start_col = 'chromStart'
+    end_col = 'chromEnd'
+
+    def __init__(self, table, engine='sql', format='vcf', sep='\t'):
+        Stage.__init__(self, format=format, sep=sep)
+        self.name = table
+        self.table = table
+        self.engine = engine
+        self.index = None
+        self.counts = dict.fromkeys(['var_count', 'line_count'], 0)
+
+    def open(self, cursor, snapshot=None):
+        Stage.open(self, cursor, snapshot=snapshot)
+        self.select = self.projection(self.table)
+        self.statements = {}
+        if (snapshot is not None):
+            self.index = snapshot.index(self.table, **self.indexArgs())
+        else:
+            self.index = getOverlapIndex(cursor, self.table, 
+                engine=self.engine, **self.indexArgs())
+
+    def indexArgs(self):
+        return {'chrom_col': self.chrom_col, 'start_col': self.start_col,
+            'end_col': self.end_col, 'columns': self.select}
+
+    # Checkpoints record the engine the rows were looked up with
+    def signature(self):
+        return Stage.signature(self) + ':' + self.table + ':' + self.engine
+
+    def chrom(self, record):
+        return record.ucscChrom
+
+    """Statement for table, prepared on first use (tables split per
+       chromosome get one each)
+    """
+    def statement(self, table):
+        sql = self.statements.get(table)
+        if (sql is None):
+            template = q.OVERLAP_SPLIT if (self.chrom_col is None) \
+                else q.OVERLAP
+            sql = q.prepare(template, columns=self.select, table=table,
+                chrom_col=self.chrom_col, start_col=self.start_col,
+                end_col=self.end_col)
+            self.statements[table] = sql
+        return sql
+
+    def execute(self, chr, pos):
+        pos = int(pos)
+        if (self.chrom_col is None):
+            table = self.table + chr
+            args = (pos, pos)
+        else:
+            table = self.table
+            args = (chr, pos, pos)
+        q.executeBinned(self.cursor, self.statement(table), table, args, 
+            pos, pos)
+
+    def close(self):
+        if (self.index is not None):
+            self.index.close()
+            if isinstance(self.index, SweepIndex):
+                u.get_connection_manager().release(self.index.conn)
+            self.index = None
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record.pos
+
+        if (self.index is not None):
+            try:
+                if (self.first_only):
+                    rows = self.index.first(chr, pos)
+                else:
+                    rows = self.index.overlapping(chr, pos)
+            except UnsortedInputError as e:
+                print(f"Cannot sweep ({e}), " + \
+                    "falling back to per-variant queries")
+                self.close()
+
+        if (self.index is None):
+            self.execute(chr, pos)
+            if (self.first_only):
+                rows = self.cursor.fetchone()
+            else:
+                rows = self.cursor.fetchall()
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (self.first_only):
+            return [] if (rows is None) else [rows]
+        return rows
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: " + \
+            f"{str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
 
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+"""Overlap with tfbsConsSites
+"""
+class TfbsConsSitesStage(OverlapStage):
+    chrom_col = None
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
+    def __init__(self, table='tfbsConsSites', engine='sql', format='vcf', 
+        sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+    # Split per chromosome (tfbsConsSites1, ...)
+    def projection(self, table):
+        return 'chrom, chromStart, chromEnd, name'
 
-                    fh_out.write('\t'.join(fields) + '\n')
+    # For some reason this table has no "chr" preceeding number
+    def chrom(self, record):
+        return record.chrom
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+    def lookup(self, record):
+        if (self.chrom(record) not in self.allowed_chrom):
+            return []
+        return OverlapStage.lookup(self, record)
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            records = []
+            for row in rows:
+                self.counts['var_count'] += 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
 
-        linenum = linenum + 1
+            record.addInfo(';'.join(records))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t', engine='sql', conn=None):
+    runStage(TfbsConsSitesStage(table=table, engine=engine, format=format, 
+        sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+class GadAllStage(OverlapStage):
+    chrom_col = 'chromosome'
+    columns = [3]
+
+    def __init__(self, table='gadAll', engine='sql', format='vcf', sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
+
+    # For some reason this table has no "chr" preceeding number
+    def chrom(self, record):
+        return record.chrom
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] += 1
+                if not fu.isOnTheList(r_tmp, str(row[0])):
+                    r_tmp.append(str(row[0]) )
+                    records.append(str(self.table) + '=' + str(row[0]))
+            record.addInfo(';'.join(records))
+
+            # Annotated lines have always been written joined with '\t ';
+            # keep that so the output stays byte-for-byte the same
+            record.space()
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(GadAllStage(table=table, engine=engine, format=format, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+class GwasCatalogStage(OverlapStage):
+    start_col = 'chromEnd'
+    columns = [5, 10]
+
+    def __init__(self, table='gwasCatalog', engine='sql', format='vcf', 
+        sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            records = []
+            for row in rows:
+                self.counts['var_count'] += 1
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[0]) + ',trait=' + str(row[1]))
+            record.addInfo(';'.join(records))
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(GwasCatalogStage(table=table, engine=engine, format=format, 
+        sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HugoStage(OverlapStage):
+    columns = [5, 6]
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, table='hugo', engine='sql', format='vcf', sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] += 1
+                t = str(str(row[0]) + ',' + str(row[1])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+            records_str = ','.join(records).replace(';', ',')
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+            record.addInfo(records_str)
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(HugoStage(table=table, engine=engine, format=format, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+class GenomicSuperDupsStage(OverlapStage):
+    first_only = True
+    columns = [7, 8, 9]
+
+    def __init__(self, table='genomicSuperDups', engine='sql', format='vcf',
+        sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            self.counts['var_count'] += 1
+            isOverlap = True
+            otherChrom = rows[0][0]
+            otherStart = rows[0][1]
+            otherEnd = rows[0][2]
+            record.info.append(';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    engine='sql', conn=None):
+    runStage(GenomicSuperDupsStage(table=table, engine=engine, 
+        format=format, sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1154,7 +1598,8 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
                 
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
+                    ' AND ' + str(pos) + ' <= ' + endName +')' + \
+                    binClause(cursor, table, pos, pos) + ';'
                 overlapsWith = []
                 cursor.execute(sql)
                 rows = cursor.fetchall()
@@ -1189,215 +1634,193 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+class CytobandStage(OverlapStage):
+    def __init__(self, table='cytoBand', engine='sql', format='vcf', 
+        sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
+        self.colindex = 12
+        self.start_col = 'txStart'
+        self.end_col = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.start_col = 'chromStart'
+            self.end_col = 'chromEnd'
+        self.columns = [self.colindex]
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            overlapsWith = []
+            for row in rows:
+                self.counts['var_count'] += 1
+                overlapsWith.append(str(row[0]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            record.addInfo(str(self.table) + '=' + str(cytoband))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(CytobandStage(table=table, engine=engine, format=format, 
+        sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class CnvStage(OverlapStage):
+    first_only = True
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    def __init__(self, table='dgv_Cnv', engine='sql', format='vcf', sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+    # Only whether a row overlaps matters
+    def projection(self, table):
+        return self.start_col
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            self.counts['var_count'] += 1
+            isOverlap = True
+            record.addInfo(str(self.table) + '=' + str(isOverlap))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(CnvStage(table=table, engine=engine, format=format, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
+
+
+"""Overlap with several CNV tables in one pass
+   lookup() returns one flag per table: with the sql engine all tables
+   are tested by a single query per variant, otherwise each table has its
+   own index. apply() appends the same <table>=True fields, in table
+   order, and writeLog() the same per-table lines as one CnvStage per
+   table would.
+"""
+class CnvTablesStage(Stage):
+    chrom_col = 'chrom'
+    start_col = 'chromStart'
+    end_col = 'chromEnd'
+
+    def __init__(self, tables=['dgv_Cnv', 'abParts_IG_T_CelReceptors',
+        'mcCarroll_Cnv', 'conrad_Cnv'], engine='sql', format='vcf', 
+        sep='\t'):
+        Stage.__init__(self, format=format, sep=sep)
+        self.name = 'CNV'
+        self.tables = list(tables)
+        self.engine = engine
+        self.indexes = None
+        self.counts = dict.fromkeys(self.tables, 0)
+
+    def open(self, cursor, snapshot=None):
+        Stage.open(self, cursor, snapshot=snapshot)
+        self.statements = [q.prepare(q.EXISTS, table=table, 
+            chrom_col=self.chrom_col, start_col=self.start_col, 
+            end_col=self.end_col) for table in self.tables]
+        self.indexes = None
+        if (snapshot is not None):
+            self.indexes = [snapshot.index(table, columns=self.start_col)
+                for table in self.tables]
+        elif (self.engine != 'sql'):
+            self.indexes = [getOverlapIndex(cursor, table, 
+                engine=self.engine, chrom_col=self.chrom_col, 
+                start_col=self.start_col, end_col=self.end_col, 
+                columns=self.start_col) for table in self.tables]
+
+    def signature(self):
+        return Stage.signature(self) + ':' + ','.join(self.tables)
+
+    def exists(self, chr, pos):
+        parts = []
+        args = []
+        for t in range(0, len(self.tables)):
+            clause, bins = q.binArgs(self.cursor, self.tables[t], pos, pos)
+            parts.append(self.statements[t].replace('{bins}', clause))
+            args = args + [chr, pos, pos] + bins
+        self.cursor.execute('select ' + ', '.join(parts) + ';', args)
+        return [bool(flag) for flag in self.cursor.fetchone()]
+
+    def lookup(self, record):
+        chr = record.ucscChrom
+        pos = record.pos
+
+        if (self.indexes is not None):
+            try:
+                return [index.first(chr, pos) is not None 
+                    for index in self.indexes]
+            except UnsortedInputError as e:
+                print(f"Cannot sweep ({e}), " + \
+                    "falling back to per-variant queries")
+                self.close()
+
+        return self.exists(chr, pos)
+
+    def apply(self, record, rows):
+        for t in range(0, len(self.tables)):
+            if (rows[t]):
+                self.counts[self.tables[t]] += 1
+                isOverlap = True
+                record.addInfo(str(self.tables[t]) + '=' + str(isOverlap))
+
+    def close(self):
+        if (self.indexes is not None):
+            for index in self.indexes:
+                index.close()
+                if isinstance(index, SweepIndex):
+                    u.get_connection_manager().release(index.conn)
+            self.indexes = None
+
+    def writeLog(self, fh_log):
+        for table in self.tables:
+            fh_log.write(f"In {str(table)}: {str(self.counts[table])} in " + \
+                f"{str(self.counts[table])} variants\n")
+
+
+def addOverlapWithCnvDatabases(vcf, format='vcf', tables=['dgv_Cnv', 
+    'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv'], 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(CnvTablesStage(tables=tables, engine=engine, format=format, 
+        sep=sep), vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(OverlapStage):
+    first_only = True
+    columns = [1, 2, 3, 4]
+
+    def __init__(self, table='targetScanS', engine='sql', format='vcf', 
+        sep='\t'):
+        OverlapStage.__init__(self, table, engine=engine, format=format, 
+            sep=sep)
+        self.name = 'miRNA'
+
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] += 1
+            self.counts['var_count'] += 1
+            t = str(rows[0][3]) + ',' +  str(rows[0][0]) + '_' + \
+                str(rows[0][1]) + '_' + str(rows[0][2])
+            t = 'miRNAsites=' + t.strip()
+            record.addInfo(t)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql', conn=None):
+    runStage(MiRNAStage(table=table, engine=engine, format=format, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout,
+        conn=conn)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -8,16 +8,371 @@ import boto3
 import time
 import jmespath
 import logging
+import threading
+import multiprocessing
+import socket
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import checkpoint as ck
+import run
 
 from configparser import ConfigParser
 
 
+# SQS takes at most 10 entries per batch request
+SQS_MAX_BATCH = 10
+
+# Attribute marking a latency probe published by intake_bench.py (no job is
+# run for it); only recognized with IntakeProbes = yes
+PROBE = 'intake_probe'
+
+# Pre-forked workers that run the jobs (None: one run.py subprocess per job)
+pool = None
+
+"""Starts the pool of warm annotation workers; each worker is replaced
+   after jobs_per_worker jobs, so jobs share little state with earlier ones
+"""
+def start_pool(workers, jobs_per_worker):
+  global pool
+  if workers > 0:
+    pool = multiprocessing.Pool(processes=workers, initializer=run.warm_up,
+                                maxtasksperchild=jobs_per_worker or None)
+  return pool
+
+"""Admission control for the jobs on this instance
+   At most max_jobs jobs are in flight (running, or waiting for a pool
+   worker) and, with max_bytes, their inputs add up to at most max_bytes;
+   a job is always taken when nothing else is in flight. After a job is
+   rejected while others run, no more are taken until one finishes. The counts are printed
+   whenever they change and written to status_file (JSON), along with the
+   latest intake probes when probes is set.
+"""
+class Scheduler(object):
+  def __init__(self, max_jobs, max_bytes=0, workers=0, status_file=None,
+               probes=False):
+    self.max_jobs = max(1, max_jobs)
+    self.max_bytes = max_bytes
+    self.workers = workers
+    self.status_file = status_file
+    self.jobs = 0
+    self.bytes = 0
+    self.rejected = 0
+    self.completed = 0
+    self.blocked = False
+    self.probes = collections.deque(maxlen=1000) if probes else None
+    self.cond = threading.Condition()
+
+  def full(self):
+    return self.jobs >= self.max_jobs or self.blocked or \
+      (self.max_bytes > 0 and self.bytes >= self.max_bytes)
+
+  """Blocks until there is room for another job
+  """
+  def wait_for_room(self):
+    with self.cond:
+      while self.full():
+        self.cond.wait()
+
+  """Number of jobs that can be taken right now (at least one)
+  """
+  def room(self):
+    with self.cond:
+      return max(1, self.max_jobs - self.jobs)
+
+  """True if a job of size bytes fits, on top of pending_jobs jobs
+     (pending_bytes bytes) already accepted from the same batch but not
+     started yet; otherwise the job is counted as rejected
+  """
+  def accepts(self, size=0, pending_jobs=0, pending_bytes=0):
+    with self.cond:
+      jobs = self.jobs + pending_jobs
+      queued = self.bytes + pending_bytes
+      if jobs == 0 or (not self.blocked and jobs < self.max_jobs and
+          (self.max_bytes == 0 or queued + size <= self.max_bytes)):
+        return True
+      self.rejected += 1
+      # Only a finishing job clears the block, so there must be one
+      self.blocked = self.jobs > 0
+      self.report()
+      return False
+
+  def started(self, size=0):
+    with self.cond:
+      self.jobs += 1
+      self.bytes += size
+      self.report()
+
+  def finished(self, size=0):
+    with self.cond:
+      self.jobs -= 1
+      self.bytes -= size
+      self.completed += 1
+      self.blocked = False
+      self.report()
+      self.cond.notify_all()
+
+  def status(self):
+    running = self.jobs if (self.workers == 0) else min(self.jobs, self.workers)
+    status = {'running': running, 'waiting': self.jobs - running,
+              'rejected': self.rejected, 'completed': self.completed,
+              'queued_bytes': self.bytes, 'max_jobs': self.max_jobs,
+              'max_bytes': self.max_bytes}
+    if self.probes is not None:
+      status['probes'] = list(self.probes)
+    return status
+
+  """True if a job item is an intake probe and probes are enabled
+  """
+  def is_probe(self, job_item):
+    return self.probes is not None and PROBE in job_item
+
+  """Records the seconds from publishing a probe to its start on a worker,
+     by intake path ('sqs' or 'webhook')
+  """
+  def probed(self, probe_id, path, latency):
+    with self.cond:
+      self.probes.append({'id': probe_id, 'path': path, 'latency': latency})
+      print(f"Probe {probe_id} started {latency * 1000:.1f} ms after "
+            f"publishing ({path})")
+      self.report()
+
+  def report(self):
+    status = self.status()
+    print(f"Jobs: {status['running']} running, {status['waiting']} waiting, "
+          f"{status['rejected']} rejected, {status['completed']} completed")
+    if self.status_file:
+      try:
+        with open(self.status_file + '.partial', 'w') as fh:
+          json.dump(status, fh)
+        os.replace(self.status_file + '.partial', self.status_file)
+      except OSError as e:
+        logging.error(e)
+
+
+# Admission control (no limit until the poller configures one)
+scheduler = Scheduler(max_jobs=1 << 30)
+
+"""Leases on the jobs this instance runs, and the SQS messages they came in
+   A job is leased by writing lease_owner (this host) and lease_expires
+   (epoch seconds) on its annotations item, on the condition that it is
+   not done and nobody else holds an unexpired lease, so a job delivered
+   again is only run by one annotator. While the jobs run, heartbeat()
+   pushes their leases and the visibility of their messages timeout
+   seconds ahead; a message is deleted once its job has finished.
+"""
+class Leases(object):
+  def __init__(self, sqs=None, queue=None, table=None, timeout=300,
+               owner=None):
+    self.sqs = sqs
+    self.queue = queue
+    self.table = table
+    self.timeout = timeout
+    self.owner = owner or socket.gethostname()
+    # job_id -> receipt handle of its latest delivery (None if unknown)
+    self.jobs = {}
+    self.lock = threading.Lock()
+
+  def dynamodb(self):
+    return run.aws_client('dynamodb')
+
+  """Leases a job delivered with handle (None for a job resumed from a
+     checkpoint). Returns 'run' if this instance should start it,
+     'running' if it already runs it here (the new handle replaces the
+     old one), 'done' if the job has completed, or 'leased' if another
+     annotator holds its lease.
+  """
+  def acquire(self, job_id, handle=None):
+    with self.lock:
+      if job_id in self.jobs:
+        if handle is not None:
+          self.jobs[job_id] = handle
+        return 'running'
+      self.jobs[job_id] = handle
+    if self.table is None:
+      return 'run'
+    now = int(time.time())
+    try:
+      self.dynamodb().update_item(
+        TableName=self.table,
+        Key={'job_id': {'S': job_id}},
+        UpdateExpression='SET lease_owner = :owner, lease_expires = :expires',
+        ConditionExpression='job_status IN (:pending, :running) AND '
+          '(attribute_not_exists(lease_expires) OR lease_expires < :now '
+          'OR lease_owner = :owner)',
+        ExpressionAttributeValues={
+          ':owner': {'S': self.owner},
+          ':expires': {'N': str(now + self.timeout)},
+          ':now': {'N': str(now)},
+          ':pending': {'S': 'PENDING'},
+          ':running': {'S': 'RUNNING'}
+        })
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        # Without the table only the message visibility guards the job
+        logging.error(e)
+        return 'run'
+      self.drop(job_id, lease=False)
+      status = self.status(job_id)
+      return 'leased' if status in [None, 'PENDING', 'RUNNING'] else 'done'
+    return 'run'
+
+  def status(self, job_id):
+    try:
+      item = self.dynamodb().get_item(
+        TableName=self.table, Key={'job_id': {'S': job_id}},
+        ProjectionExpression='job_status').get('Item', {})
+    except ClientError as e:
+      logging.error(e)
+      return None
+    return item.get('job_status', {}).get('S')
+
+  """Forgets a job without deleting its message, which is delivered again
+     after its visibility timeout (e.g. the job could not be submitted)
+  """
+  def drop(self, job_id, lease=True):
+    with self.lock:
+      self.jobs.pop(job_id, None)
+    if lease:
+      self.release(job_id)
+
+  """Deletes the message of a finished job and releases its lease
+  """
+  def finished(self, job_id):
+    with self.lock:
+      handle = self.jobs.pop(job_id, None)
+    if handle is not None and self.sqs is not None:
+      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message_batch
+      sqs_batch(self.sqs.delete_message_batch, self.queue, [handle])
+    self.release(job_id)
+
+  def release(self, job_id):
+    if self.table is None:
+      return
+    try:
+      self.dynamodb().update_item(
+        TableName=self.table,
+        Key={'job_id': {'S': job_id}},
+        UpdateExpression='REMOVE lease_owner, lease_expires',
+        ConditionExpression='lease_owner = :owner',
+        ExpressionAttributeValues={':owner': {'S': self.owner}})
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        logging.error(e)
+
+  """Extends the visibility of the messages and the leases of the jobs in
+     flight by timeout seconds
+  """
+  def extend(self):
+    with self.lock:
+      jobs = dict(self.jobs)
+    handles = [handle for handle in jobs.values() if handle is not None]
+    if handles and self.sqs is not None:
+      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility_batch
+      sqs_batch(self.sqs.change_message_visibility_batch, self.queue, handles,
+                VisibilityTimeout=self.timeout)
+    if self.table is None:
+      return
+    expires = str(int(time.time()) + self.timeout)
+    for job_id in jobs:
+      try:
+        self.dynamodb().update_item(
+          TableName=self.table,
+          Key={'job_id': {'S': job_id}},
+          UpdateExpression='SET lease_expires = :expires',
+          ConditionExpression='lease_owner = :owner',
+          ExpressionAttributeValues={':owner': {'S': self.owner},
+                                     ':expires': {'N': expires}})
+      except ClientError as e:
+        logging.error(f"Unable to extend the lease on job {job_id}: {e}")
+
+  """Calls extend() every interval seconds (run in a daemon thread)
+  """
+  def heartbeat(self, interval):
+    while True:
+      time.sleep(interval)
+      try:
+        self.extend()
+      except Exception as e:
+        logging.error(e)
+
+
+# Leases of the jobs in flight (messages are not tracked until the poller
+# configures them)
+leases = Leases()
+
+def job_finished(job_id, size=0):
+  scheduler.finished(size)
+  leases.finished(job_id)
+
+def job_failed(job_id, e, size=0):
+  logging.error(e)
+  job_finished(job_id, size)
+
+def wait_for_job(job_id, proc, size):
+  proc.wait()
+  job_finished(job_id, size)
+
+"""Runs a job on a pooled worker, or in a run.py subprocess without a pool;
+   size (input bytes) is accounted in the scheduler until the job ends
+"""
+def launch(file_path, job_id, user_id, disabled_stages=None, size=0):
+  if pool is not None:
+    scheduler.started(size)
+    pool.apply_async(run.run_job,
+                     (file_path, job_id, user_id, disabled_stages or None),
+                     callback=lambda result: job_finished(job_id, size),
+                     error_callback=lambda e: job_failed(job_id, e, size))
+    return
+  # https://docs.python.org/3/library/subprocess.html
+  args = ["python","run.py", f"{file_path}", f"{job_id}", f"{user_id}"]
+  if disabled_stages:
+    args.append(disabled_stages)
+  proc = subprocess.Popen(args)
+  scheduler.started(size)
+  threading.Thread(target=wait_for_job, args=(job_id, proc, size),
+                   daemon=True).start()
+
+
+"""Starts a latency probe the way launch() starts a job: on a pooled
+   worker, or right away without a pool
+"""
+def start_probe(job_item, path):
+  try:
+    probe_id = job_item[PROBE]['S']
+    submitted = float(job_item['submit_time']['N'])
+  except (KeyError, TypeError, ValueError) as e:
+    logging.error(e)
+    return
+  if pool is not None:
+    pool.apply_async(time.time, callback=lambda started:
+                     scheduler.probed(probe_id, path, started - submitted))
+  else:
+    scheduler.probed(probe_id, path, time.time() - submitted)
+
+
+"""Size of a job's input file in S3 (only looked up when the scheduler
+   limits queued bytes)
+"""
+def job_size(job):
+  if scheduler.max_bytes == 0:
+    return 0
+  try:
+    head = run.aws_client('s3').head_object(
+      Bucket=job['s3_inputs_bucket']['S'], Key=job['s3_key_input_file']['S'])
+    return int(head['ContentLength'])
+  except (ClientError, KeyError, TypeError) as e:
+    logging.error(e)
+    return 0
+
+
+"""Downloads a job's input and launches it; False if the job could not be
+   launched (True once it is running, even if its status update failed)
+"""
 def submit_annonations(job):
   # Get configuration
   config = ConfigParser(os.environ)
   config.read('ann_config.ini')
 
-  region = config['aws']['AwsRegionName']
   table_name = config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE']
 
   if job is None:
@@ -40,6 +395,8 @@ def submit_annonations(job):
   except Exception as e:
     logging.error(e)
     return False
+  # Optional list of stages the user does not need (string set)
+  disabled_stages = ','.join(job.get('disabled_stages', {}).get('SS', []))
 
 
   if job_id is None or input_file_name is None or user_id is None:
@@ -61,20 +418,21 @@ def submit_annonations(job):
 
   # https://ashish.ch/generating-signature-version-4-urls-using-boto3/
   # Initialize s3 client
-  s3 = boto3.resource('s3', region_name=region)
+  s3 = run.aws_client('s3')
   # example in download file
   # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
   try:
-    s3.meta.client.download_file(input_bucket, input_file_key, file_path)
+    s3.download_file(input_bucket, input_file_key, file_path)
   except ClientError as error:
 
-    logging.error(e)
+    logging.error(error)
     return False
 
-  # Spawn a subprocess to run the annotator using the provided input file.
-  # https://docs.python.org/3/library/subprocess.html
+  # Hand the job to a warm worker (or spawn a subprocess) to run the
+  # annotator on the input file.
   try:
-    subprocess.Popen(["python","run.py", f"{file_path}", f"{annotation_job_id}", f"{user_id}"])
+    launch(file_path, annotation_job_id, user_id, disabled_stages,
+           size=os.path.getsize(file_path))
   except Exception as e:
     logging.error(e)
     return False
@@ -82,46 +440,245 @@ def submit_annonations(job):
   # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
   # https://stackoverflow.com/questions/63418641/dynamodb-boto3-conditional-update
   # Update the job status in dynamoDB
-  client = boto3.client('dynamodb',region_name=region)
+  # A job delivered again after an annotator stopped is RUNNING already;
+  # its lease keeps it from running twice. Once launched the job is
+  # running either way, so a failed update is only logged.
+  client = run.aws_client('dynamodb')
   try:
     client.update_item(TableName=table_name,
                        Key={'job_id': {'S': job_id}},
                        UpdateExpression='SET job_status = :newVal',
-                       ConditionExpression='job_status = :oldVal',
+                       ConditionExpression='job_status IN (:oldVal, :newVal)',
                        ExpressionAttributeValues={
                            ':newVal': {'S': 'RUNNING'},
                            ':oldVal': {'S': 'PENDING'}
                        })
   except Exception as e:
     logging.error(e)
-    return False
 
   return True
 
-if __name__ == "__main__":
-  config = ConfigParser(os.environ)
-  config.read('ann_config.ini')
+"""Relaunches the jobs an earlier annotator on this instance left with a
+   checkpoint (e.g. before a reboot); run_job resumes them from there
+"""
+def resume_annotations():
+  for job_id in os.listdir("annotation_jobs"):
+    folder = f"annotation_jobs/{job_id}"
+    if not os.path.isdir(folder):
+      continue
+    for name in os.listdir(folder):
+      if not name.endswith(ck.SUFFIX):
+        continue
+      state = ck.readManifest(f"{folder}/{name}")
+      file_path = f"{folder}/{name[:-len(ck.SUFFIX)]}"
+      if state is None or not os.path.exists(file_path):
+        continue
+      user_id = state.get('job', {}).get('user_id')
+      if user_id is None or ck.isRunning(state):
+        continue
+      # Another annotator may have taken the job up again meanwhile
+      if leases.acquire(job_id) != 'run':
+        continue
+      print(f"Resuming annotation job {job_id} from its checkpoint")
+      try:
+        launch(file_path, job_id, user_id, state['job'].get('disabled_stages'),
+               size=os.path.getsize(file_path))
+      except Exception as e:
+        logging.error(e)
+        leases.drop(job_id)
 
-  region = config['aws']['AwsRegionName']
-  table_name = config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-  topic = config['sns']['AWS_SNS_ARN_TOPIC']
-  queue = config['sqs']['AWS_SQS_QUEUE_URL']
-  
+"""Calls an SQS batch request (delete_message_batch or
+   change_message_visibility_batch) for the receipt handles, ten at a time;
+   entries that fail through no fault of the request are retried once.
+   Returns the handles that still failed.
+"""
+def sqs_batch(request, queue, handles, retry=True, **fields):
+  failed = []
+  for i in range(0, len(handles), SQS_MAX_BATCH):
+    chunk = handles[i:i + SQS_MAX_BATCH]
+    entries = [dict(Id=str(j), ReceiptHandle=chunk[j], **fields)
+               for j in range(len(chunk))]
+    try:
+      resp = request(QueueUrl=queue, Entries=entries)
+    except ClientError as e:
+      logging.error(e)
+      failed.extend(chunk)
+      continue
+    retries = []
+    for entry in resp.get('Failed', []):
+      logging.error(f"SQS batch entry failed: {entry}")
+      if retry and not entry.get('SenderFault', False):
+        retries.append(chunk[int(entry['Id'])])
+      else:
+        failed.append(chunk[int(entry['Id'])])
+    if retries:
+      failed.extend(sqs_batch(request, queue, retries, retry=False, **fields))
+  return failed
+
+"""Reads the job in a message; None if it cannot be decoded or is
+   incomplete
+"""
+def read_job(message):
+  try:
+    data = json.loads(message['body'])
+    job_item = json.loads(data['Message'])
+    print('')
+    print(f"Job_item received from annotator:{job_item}")
+    print('')
+  except json.decoder.JSONDecodeError as e:
+      print(f'Fail to decode message: {message["body"]} {e}')
+      return None
+
+  if job_item is None:
+    print('job_item is None')
+    return None
+
+  if scheduler.is_probe(job_item):
+    return job_item
+  if 'job_id' not in job_item or 'user_id' not in job_item:
+    print("job_item is not complete")
+    print(job_item)
+    return None
+  return job_item
+
+"""Handles a batch of received messages
+   Each job is leased (see Leases) and admitted in order, so that the batch
+   as a whole stays within the scheduler's limits, then the jobs are
+   submitted concurrently; their messages are deleted when they finish.
+   A job delivered again while it runs here keeps running under the new
+   message, the messages of completed jobs are deleted, and those of jobs
+   leased elsewhere come back after a lease period. Jobs that do not fit
+   are put back on the queue right away; the rest (unreadable messages and
+   failed submissions) reappear after their visibility timeout.
+"""
+def handle_messages(sqs, queue, messages):
+  accepted = []
+  rejected = []
+  done = []
+  deferred = []
+  pending_bytes = 0
+  for message in messages:
+    job_item = read_job(message)
+    if job_item is None:
+      continue
+    if scheduler.is_probe(job_item):
+      start_probe(job_item, 'sqs')
+      done.append(message['handle'])
+      continue
+    if rejected:
+      rejected.append(message['handle'])
+      continue
+    try:
+      job_id = job_item['job_id']['S']
+    except (KeyError, TypeError) as e:
+      logging.error(e)
+      continue
+    lease = leases.acquire(job_id, message['handle'])
+    if lease == 'running':
+      print(f"Job {job_id} is already running here")
+      continue
+    if lease != 'run':
+      print(f"Skipping job {job_id}: {lease}")
+      (done if lease == 'done' else deferred).append(message['handle'])
+      continue
+    size = job_size(job_item)
+    if not scheduler.accepts(size, len(accepted), pending_bytes):
+      leases.drop(job_id)
+      rejected.append(message['handle'])
+      continue
+    accepted.append((job_id, job_item))
+    pending_bytes += size
+
+  if accepted:
+    with ThreadPoolExecutor(max_workers=len(accepted)) as executor:
+      status = list(executor.map(submit_annonations,
+                                 [job_item for job_id, job_item in accepted]))
+    for i in range(len(accepted)):
+      if not status[i]:
+        leases.drop(accepted[i][0])
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message_batch
+  if done:
+    sqs_batch(sqs.delete_message_batch, queue, done)
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility_batch
+  if deferred:
+    sqs_batch(sqs.change_message_visibility_batch, queue, deferred,
+              VisibilityTimeout=leases.timeout)
+  # Put the jobs that do not fit back on the queue right away
+  if rejected:
+    sqs_batch(sqs.change_message_visibility_batch, queue, rejected,
+              VisibilityTimeout=0)
+
+"""Takes a job pushed to this instance (not received from SQS): leases it,
+   admits it and submits it. Returns True if it was taken; otherwise the
+   job is left to its copy in the queue.
+"""
+def take_job(job_item):
+  if scheduler.is_probe(job_item):
+    start_probe(job_item, 'webhook')
+    return True
+  try:
+    job_id = job_item['job_id']['S']
+  except (KeyError, TypeError) as e:
+    logging.error(e)
+    return False
+  lease = leases.acquire(job_id)
+  if lease != 'run':
+    print(f"Skipping job {job_id}: {lease}")
+    return False
+  if not scheduler.accepts(job_size(job_item)):
+    leases.drop(job_id)
+    return False
+  if not submit_annonations(job_item):
+    leases.drop(job_id)
+    return False
+  return True
+
+"""Sets up the worker pool, the scheduler and the job leases of this
+   instance from the configuration, starts the lease heartbeat and
+   relaunches checkpointed jobs; returns the SQS client
+"""
+def start_annotator(config):
+  global scheduler, leases
   if not os.path.exists("annotation_jobs"):
     os.makedirs("annotation_jobs")
+  workers = config.getint('annotator', 'PoolWorkers', fallback=0)
+  start_pool(workers, config.getint('annotator', 'JobsPerWorker', fallback=0))
+  scheduler = Scheduler(
+    max_jobs=config.getint('annotator', 'MaxJobs', fallback=4),
+    max_bytes=config.getint('annotator', 'MaxQueuedMB', fallback=0) * 1024 * 1024,
+    workers=workers,
+    status_file=config.get('annotator', 'StatusFile', fallback='') or None,
+    probes=config.getboolean('annotator', 'IntakeProbes', fallback=False))
   # Connect to SQS and get the message queue
-  sqs = boto3.client('sqs', region_name=region)
-  # Poll the message queue in a loop 
+  sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+  # Keep the messages of running jobs hidden (and their leases held) until
+  # the jobs finish
+  leases = Leases(sqs, config['sqs']['AWS_SQS_QUEUE_URL'],
+    config['dynamodb']['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    timeout=config.getint('annotator', 'VisibilityTimeout', fallback=300))
+  threading.Thread(target=leases.heartbeat, daemon=True,
+    args=(config.getint('annotator', 'HeartbeatSeconds', fallback=60),)).start()
+  resume_annotations()
+  return sqs
+
+"""Polls the message queue in a loop
+"""
+def poll_queue(sqs, queue, max_messages=SQS_MAX_BATCH):
   while True:
+      # When this instance is full, stop receiving so that the messages
+      # stay in the queue for other instances
+      scheduler.wait_for_room()
+
       # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-short-and-long-polling.html
       # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
 
-      # Attempt to read a message from the queue
+      # Attempt to read as many messages as this instance has room for
       # Use long polling - DO NOT use sleep() to wait between polls
       try:
           resp = sqs.receive_message(
               QueueUrl=queue,
-              WaitTimeSeconds=20
+              WaitTimeSeconds=20,
+              MaxNumberOfMessages=max(1, min(max_messages, scheduler.room()))
           )
       except ClientError as e:
           logging.error(e)
@@ -134,37 +691,12 @@ if __name__ == "__main__":
 
         print("Response is empty, waiting for sqs receive message")
         continue
-      for message in response:
-        try:
-          data = json.loads(message['body'])
-          job_item = json.loads(data['Message'])
-          print('')
-          print(f"Job_item received from annotator:{job_item}")
-          print('')
-        except json.decoder.JSONDecodeError as e:
-            print(f'Fail to decode message: {message["body"]} {e}')
-            continue
-
-
-      
-      # Delete the message from the queue, if job was successfully submitted
-      if 'job_id' not in job_item or 'user_id' not in job_item:
-        print("job_item is not complete")
-        print(job_item)
-        continue
+      handle_messages(sqs, queue, response)
 
-      if job_item is None:
-        print('job_item is None')
-        continue
+if __name__ == "__main__":
+  config = ConfigParser(os.environ)
+  config.read('ann_config.ini')
 
-      status = submit_annonations(job_item)
-      if not status:
-          continue
-      # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
-      try:
-          response = sqs.delete_message(
-              QueueUrl=queue,
-              ReceiptHandle=message['handle']
-          )
-      except ClientError as e:
-          logging.error(e)
\ No newline at end of file
+  sqs = start_annotator(config)
+  poll_queue(sqs, config['sqs']['AWS_SQS_QUEUE_URL'],
+             config.getint('sqs', 'AWS_SQS_MAX_MESSAGES', fallback=10))
@@ -9,16 +9,117 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
+import re
+import json
+import base64
+import logging
+import threading
 import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, jsonify, request
+try:
+  from cryptography import x509
+  from cryptography.exceptions import InvalidSignature
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+  sys.exit("annotator_webhook.py needs the cryptography package to check "
+           "SNS signatures: pip install cryptography")
+
+import annotator
+import run
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read('ann_config.ini')
 
 app = Flask(__name__)
-environment = 'ann_config.Config'
-app.config.from_object(environment)
 
-# Connect to SQS and get the message queue
+topic = config['sns']['AWS_SNS_ARN_TOPIC']
+
+# Jobs are taken in the background so that SNS gets its answer right away
+# (it retries deliveries that take longer than 15 seconds)
+intake = ThreadPoolExecutor(
+  max_workers=config.getint('webhook', 'IntakeThreads', fallback=4))
+
+# Fields signed by SNS, in the order they are signed, per message type
+# https://docs.aws.amazon.com/sns/latest/dg/sns-verify-signature-of-message.html
+SIGNED_FIELDS = {
+  'Notification': ['Message', 'MessageId', 'Subject', 'Timestamp',
+                   'TopicArn', 'Type'],
+  'SubscriptionConfirmation': ['Message', 'MessageId', 'SubscribeURL',
+                               'Timestamp', 'Token', 'TopicArn', 'Type'],
+  'UnsubscribeConfirmation': ['Message', 'MessageId', 'SubscribeURL',
+                              'Timestamp', 'Token', 'TopicArn', 'Type']
+}
+
+SIGNATURE_HASHES = {'1': hashes.SHA1, '2': hashes.SHA256}
+
+# Signing certificates must come from SNS itself
+SIGNING_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+
+# Signing certificates by URL (SNS rotates them rarely)
+_certs = {}
+_certs_lock = threading.Lock()
+
+
+"""Public key of the certificate SNS signed a message with
+"""
+def signing_key(url):
+  parts = urlparse(url)
+  if parts.scheme != 'https' or not SIGNING_HOST.match(parts.hostname or '') \
+      or not parts.path.endswith('.pem'):
+    raise ValueError(f"Unexpected signing certificate URL: {url}")
+  with _certs_lock:
+    cert = _certs.get(url)
+  if cert is None:
+    resp = requests.get(url, timeout=5)
+    resp.raise_for_status()
+    cert = x509.load_pem_x509_certificate(resp.content)
+    with _certs_lock:
+      _certs[url] = cert
+  return cert.public_key()
 
-# Check if requests queue exists, otherwise create it
+
+"""True if an SNS message carries a valid signature for its fields
+"""
+def verify_sns(message):
+  fields = SIGNED_FIELDS.get(message.get('Type'))
+  algorithm = SIGNATURE_HASHES.get(str(message.get('SignatureVersion')))
+  if fields is None or algorithm is None:
+    return False
+  signed = ''.join([f"{name}\n{message[name]}\n" for name in fields
+                    if message.get(name) is not None])
+  try:
+    key = signing_key(message['SigningCertURL'])
+    key.verify(base64.b64decode(message['Signature']), signed.encode('utf-8'),
+               padding.PKCS1v15(), algorithm())
+  except (KeyError, ValueError, InvalidSignature,
+          requests.exceptions.RequestException) as e:
+    logging.error(f"Rejecting SNS message {message.get('MessageId')}: "
+                  f"{type(e).__name__} {e}")
+    return False
+  return True
+
+
+"""Hands a job to the local workers; its copy in the SQS queue (the queue
+   is subscribed to the same topic) is deleted once the job finishes, or
+   picked up by a poller if the job cannot be taken here
+"""
+def take_job(body):
+  try:
+    job_item = json.loads(body)
+  except json.decoder.JSONDecodeError as e:
+    print(f'Fail to decode message: {body} {e}')
+    return
+  try:
+    annotator.take_job(job_item)
+  except Exception as e:
+    logging.error(e)
 
 
 '''
@@ -34,21 +135,69 @@ def annotate():
   print(request)
   if (request.method == 'GET'):
     return jsonify({
-      "code": 405, 
+      "code": 405,
       "error": "Expecting SNS POST request."
     }), 405
 
+  # SNS posts its messages as JSON with a text/plain content type
+  try:
+    message = json.loads(request.get_data(as_text=True))
+  except json.decoder.JSONDecodeError as e:
+    return jsonify({
+      "code": 400,
+      "error": f"Expecting an SNS message: {e}"
+    }), 400
+
   # Check message type
+  message_type = request.headers.get('x-amz-sns-message-type',
+                                     message.get('Type'))
+  if message_type != message.get('Type') or message.get('TopicArn') != topic:
+    return jsonify({
+      "code": 400,
+      "error": "Unexpected message type or topic."
+    }), 400
+  if not verify_sns(message):
+    return jsonify({
+      "code": 403,
+      "error": "Invalid SNS message signature."
+    }), 403
 
   # Confirm SNS topic subscription confirmation
+  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.confirm_subscription
+  if message_type == 'SubscriptionConfirmation':
+    try:
+      run.aws_client('sns').confirm_subscription(TopicArn=topic,
+                                                 Token=message['Token'])
+    except Exception as e:
+      logging.error(e)
+      return jsonify({
+        "code": 500,
+        "error": f"Unable to confirm subscription: {e}"
+      }), 500
+    return jsonify({
+      "code": 200,
+      "message": "Subscription confirmed."
+    }), 200
 
   # Process job request notification
+  if message_type == 'Notification':
+    intake.submit(take_job, message['Message'])
 
   return jsonify({
-    "code": 200, 
+    "code": 200,
     "message": "Annotation job request processed."
   }), 200
 
-app.run('0.0.0.0', debug=True)
 
-### EOF
\ No newline at end of file
+if __name__ == '__main__':
+  sqs = annotator.start_annotator(config)
+  # The queue still gets every job, so jobs published while the webhook was
+  # down (or that did not fit here) are not lost
+  if config.getboolean('webhook', 'PollQueue', fallback=True):
+    threading.Thread(target=annotator.poll_queue, daemon=True, args=(
+      sqs, config['sqs']['AWS_SQS_QUEUE_URL'],
+      config.getint('sqs', 'AWS_SQS_MAX_MESSAGES', fallback=10))).start()
+  app.run('0.0.0.0', port=config.getint('webhook', 'Port', fallback=5000),
+          threaded=True)
+
+### EOF
@@ -0,0 +1,209 @@
+# checkpoint.py
+#
+# Progress manifests for resuming interrupted annotation jobs
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import hashlib
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+SUFFIX = '.checkpoint.json'
+
+# Bytes read at a time when hashing files
+CHUNK = 1 << 20
+
+
+"""sha256 of the first size bytes of a file (all of it if size is None)
+   as a hashlib object, so that the bytes appended later can be added;
+   None if the file is missing or shorter than size
+"""
+def fileHash(path, size=None):
+    if not os.path.isfile(path):
+        return None
+    if (size is None):
+        size = os.path.getsize(path)
+    elif (os.path.getsize(path) < size):
+        return None
+
+    digest = hashlib.sha256()
+    fh = open(path, 'rb')
+    left = size
+    while (left > 0):
+        data = fh.read(min(CHUNK, left))
+        if (len(data) == 0):
+            break
+        digest.update(data)
+        left = left - len(data)
+    fh.close()
+    return digest
+
+
+"""Reads a manifest; None if it is missing or unreadable
+"""
+def readManifest(path):
+    try:
+        fh = open(path)
+        state = json.load(fh)
+        fh.close()
+    except (OSError, ValueError):
+        return None
+    return state
+
+
+"""True if the process that saved a manifest is still running on this host
+"""
+def isRunning(state):
+    pid = state.get('pid')
+    if (pid is None or pid == os.getpid()):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+"""Progress of one annotation job
+   The manifest (<input>.checkpoint.json, next to the input) records the
+   input checksum, the run mode and stage signatures, and the file the job
+   resumes from: its name, length and sha256, along with the stage
+   counters so far. It is rewritten atomically after every completed stage
+   (or every few blocks of a fused run). With a bucket the manifest and the
+   file it names are also copied to S3 under prefix, so a job can resume on
+   another instance.
+"""
+class Checkpoint(object):
+    def __init__(self, infile, bucket=None, prefix='', job=None):
+        self.infile = infile
+        self.path = infile + SUFFIX
+        self.dir = os.path.dirname(infile)
+        self.bucket = bucket or None
+        self.prefix = prefix
+        self.job = job or {}
+        self.state = None
+        self.saved = None
+        self.digest = None
+        self.s3 = None
+
+    def client(self):
+        if (self.s3 is None):
+            # Only needed when checkpoints are copied to S3
+            import boto3
+            self.s3 = boto3.client('s3',
+                region_name=config.get('aws', 'AwsRegionName', fallback=None))
+        return self.s3
+
+    def key(self, name):
+        return self.prefix + name
+
+    def upload(self, name):
+        self.client().upload_file(os.path.join(self.dir, name), self.bucket,
+            self.key(name))
+
+    def download(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client().download_file(self.bucket, self.key(name),
+                os.path.join(self.dir, name))
+        except ClientError:
+            return False
+        return True
+
+    """The saved manifest or None; with a bucket and no local manifest, the
+       manifest and the file it names are fetched from S3 first
+    """
+    def load(self):
+        if (not os.path.exists(self.path) and self.bucket is not None):
+            if not self.download(os.path.basename(self.path)):
+                return None
+            state = readManifest(self.path)
+            if (state is None or not self.download(state['output'])):
+                return None
+        return readManifest(self.path)
+
+    """Begins checkpointing a run in mode ('stages' or 'fused') of stages
+       Returns the saved progress if it was written for the same input,
+       mode and stages and the file it names is intact (anything written to
+       it after the checkpoint is cut off), otherwise None. After a resume
+       self.digest holds the sha256 of the file so far.
+    """
+    def start(self, mode, stages):
+        self.state = {'input': fileHash(self.infile).hexdigest(),
+            'mode': mode, 'stages': [stage.signature() for stage in stages],
+            'job': self.job}
+        self.saved = None
+        self.digest = None
+
+        state = self.load()
+        if (state is None):
+            return None
+        for k in ['input', 'mode', 'stages']:
+            if (state.get(k) != self.state[k]):
+                print(f"Ignoring checkpoint {self.path}: {k} changed")
+                return None
+
+        output = os.path.join(self.dir, state['output'])
+        digest = fileHash(output, state['bytes'])
+        if (digest is None or digest.hexdigest() != state['sha256']):
+            print(f"Ignoring checkpoint {self.path}: {state['output']} " + \
+                "does not match")
+            return None
+        if (os.path.getsize(output) > state['bytes']):
+            fh = open(output, 'r+b')
+            fh.truncate(state['bytes'])
+            fh.close()
+
+        self.saved = state
+        self.digest = digest
+        return state
+
+    """Records that the job can resume from the first size bytes of output
+       (sha256 hex digest), with the progress given as keywords
+    """
+    def save(self, output, digest, size, **progress):
+        state = dict(self.state)
+        state.update(progress)
+        state.update({'output': os.path.basename(output), 'bytes': size,
+            'sha256': digest, 'time': int(time.time()), 'pid': os.getpid()})
+
+        partial = self.path + '.partial'
+        fh = open(partial, 'w')
+        json.dump(state, fh, indent=2)
+        fh.close()
+        os.replace(partial, self.path)
+
+        if (self.bucket is not None):
+            # The manifest goes last so it never names a file not yet copied
+            self.upload(state['output'])
+            self.upload(os.path.basename(self.path))
+            if (self.saved is not None and
+                self.saved['output'] != state['output']):
+                self.client().delete_object(Bucket=self.bucket,
+                    Key=self.key(self.saved['output']))
+        self.saved = state
+
+    """Removes the manifest (and the S3 copies) once the job is done
+    """
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if (self.bucket is not None and self.saved is not None):
+            for name in [os.path.basename(self.path), self.saved['output']]:
+                self.client().delete_object(Bucket=self.bucket,
+                    Key=self.key(name))
+        self.saved = None
+
+### EOF
@@ -0,0 +1,195 @@
+# dbsnp_filter.py
+#
+# Bloom filter over dbSNP (chromosome, position, variant class), used to
+# skip the dbSNP lookup for variants that cannot be in the table
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import os
+import json
+import math
+import shutil
+import zlib
+import numpy as np
+import pymysql
+
+import utils as u
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+MANIFEST = 'filter.json'
+
+# Rows streamed from dbSNP per chunk while building
+CHUNK = 100000
+
+
+"""splitmix64 finalizer over an array of uint64 (wraps around)
+"""
+def mix64(x):
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+"""Keys of positions of one chromosome for a variant class (the INFO
+   column of dbSNP: SNV, DIV, MNV, MIXED, ...)
+"""
+def keys(positions, varclass):
+    code = zlib.crc32(str(varclass).encode('utf-8')) & 0xff
+    return (np.asarray(positions, dtype=np.uint64) << np.uint64(8)) | \
+        np.uint64(code)
+
+
+"""Bit positions of the keys in a filter of m bits with k hash functions
+   (double hashing), as an array of shape (len(keys), k)
+"""
+def bitPositions(keys, m, k):
+    h1 = mix64(keys)
+    h2 = mix64(h1 ^ np.uint64(0x9e3779b97f4a7c15)) | np.uint64(1)
+    i = np.arange(k, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(m)
+
+
+"""Filter size (bits) and hash count for n keys at false-positive rate p
+"""
+def dimensions(n, p):
+    n = max(int(n), 1)
+    m = int(math.ceil(-n * math.log(p) / (math.log(2) ** 2)))
+    m = max(64, ((m + 7) // 8) * 8)
+    k = max(1, int(round((m / float(n)) * math.log(2))))
+    return m, k
+
+
+def addKeys(bits, keys, m, k):
+    pos = bitPositions(keys, m, k).ravel()
+    np.bitwise_or.at(bits, (pos >> np.uint64(3)).astype(np.int64),
+        (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+
+
+"""Builds one filter per chromosome from the dbSNP table under root
+   Rows are streamed through a server-side cursor; the files are written
+   next to root and moved into place at the end, so running annotators
+   keep the old filter until they reopen it.
+"""
+def build(root, fp_rate=0.01, version='', conn=None):
+    if (conn is None):
+        with u.pooled_connection() as conn:
+            return build(root, fp_rate=fp_rate, version=version, conn=conn)
+
+    root = os.path.abspath(root)
+    partial = root + '.partial'
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+
+    cursor = conn.cursor()
+    cursor.execute('select CHR, count(*) from dbSNP group by CHR;')
+    counts = dict([(str(row[0]), int(row[1])) for row in cursor.fetchall()])
+
+    manifest = {'version': version, 'fp_rate': fp_rate, 'chroms': {}}
+    for chrom in sorted(counts):
+        m, k = dimensions(counts[chrom], fp_rate)
+        bits = np.zeros(m // 8, dtype=np.uint8)
+
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute('select POS, INFO from dbSNP where CHR=%s;', (chrom,))
+        while True:
+            rows = cursor.fetchmany(CHUNK)
+            if (len(rows) == 0):
+                break
+            by_class = {}
+            for pos, info in rows:
+                by_class.setdefault(str(info), []).append(int(pos))
+            for varclass in by_class:
+                addKeys(bits, keys(by_class[varclass], varclass), m, k)
+        cursor.close()
+
+        filename = str(len(manifest['chroms'])) + '.npy'
+        np.save(os.path.join(partial, filename), bits)
+        manifest['chroms'][chrom] = {'file': filename, 'rows': counts[chrom],
+            'bits': m, 'hashes': k}
+        print(f"dbSNP {chrom}: {counts[chrom]} rows, {m // 8} bytes, " + \
+            f"{k} hashes")
+
+    fh = open(os.path.join(partial, MANIFEST), 'w')
+    json.dump(manifest, fh, indent=2)
+    fh.close()
+
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.rename(partial, root)
+    return manifest
+
+
+"""A filter directory written by build()
+   The bit arrays are memory-mapped, so every worker on the host shares
+   them through the OS page cache. mightContain() never answers False
+   for a variant in the dbSNP table the filter was built from, and answers
+   True for a variant that is not in it with probability fp_rate.
+"""
+class DbSnpFilter(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        fh = open(os.path.join(self.root, MANIFEST))
+        self.manifest = json.load(fh)
+        fh.close()
+        self.version = self.manifest['version']
+        self.bits = {}
+
+    def get(self, chrom):
+        bits = self.bits.get(chrom)
+        if (bits is None):
+            info = self.manifest['chroms'][chrom]
+            bits = np.load(os.path.join(self.root, info['file']),
+                mmap_mode='r')
+            self.bits[chrom] = bits
+        return bits
+
+    """One flag per position of chrom (dbSNP naming, no 'chr')
+    """
+    def mightContain(self, chrom, positions, varclass):
+        info = self.manifest['chroms'].get(str(chrom))
+        if (info is None):
+            return np.zeros(len(positions), dtype=bool)
+        bits = self.get(str(chrom))
+        pos = bitPositions(keys(positions, varclass), info['bits'],
+            info['hashes'])
+        found = (bits[(pos >> np.uint64(3)).astype(np.int64)] >>
+            (pos & np.uint64(7)).astype(np.uint8)) & np.uint8(1)
+        return found.all(axis=1)
+
+
+_filters = {}
+
+"""Returns the DbSnpFilter at root, opened once per process
+"""
+def open_filter(root):
+    dbsnp_filter = _filters.get(root)
+    if (dbsnp_filter is None):
+        dbsnp_filter = DbSnpFilter(root)
+        _filters[root] = dbsnp_filter
+    return dbsnp_filter
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) not in [2, 3]):
+        print("Usage: python dbsnp_filter.py <filter dir> [false positive rate]")
+        sys.exit(1)
+    fp_rate = float(sys.argv[2]) if (len(sys.argv) == 3) else \
+        config.getfloat('ann', 'DbSnpFilterFPRate', fallback=0.01)
+    manifest = build(sys.argv[1], fp_rate=fp_rate,
+        version=config.get('ann', 'ReferenceVersion', fallback=''))
+    print(f"dbSNP filter ({manifest['version']}, {fp_rate} false " + \
+        f"positives) written to {sys.argv[1]}")
+
+### EOF
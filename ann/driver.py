@@ -12,110 +12,542 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import multiprocessing
+from itertools import islice
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
+import utils as u
 import annotate as ann
+import snapshot as snap
+import dbsnp_filter as dbf
+import checkpoint as ck
+from variant_cache import VariantCache, writeCacheLog
 
-def run(infile, format):
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 
+    'ann_config.ini'))
 
-    print("Running . . .")
+"""Stage registry, in the order the stages are applied (and their INFO
+   keys appear): name, the stages whose annotations the stage reads, the
+   INFO keys it adds and a factory taking the format. Stages read only the
+   input columns when they fetch rows, so the fetches for a block can run
+   concurrently; only apply() follows this order.
+"""
+STAGES = [
+    ('dbSNP', [], ['DB', 'VC', 'GMAF'], 
+        lambda format: ann.DbSnpStage(
+            batch_size=config.getint('ann', 'DbSnpBatchSize', fallback=0),
+            dbsnp_filter=getDbSnpFilter(), format=format)),
+    ('BigRefGene', [], ['name', 'name2', 'transcriptStrand', 
+        'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+        'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA', 
+        'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+        'inCodingRegion', 'spliceInfo', 'uorfChange'],
+        lambda format: ann.BigRefGeneStage(batch_size=config.getint('ann', 
+            'BigRefGeneBatchSize', fallback=0), format=format)),
+    # Counts locations by the positionType BigRefGene adds
+    ('Genes', ['BigRefGene'], ['name2', 'name', 'transcriptStrand', 'exon',
+        'non_coding_exon', 'putativePromoterRegion', 'positionType'],
+        lambda format: ann.GenesStage(table='refGene', promoter_offset=500, 
+            format=format)),
+    ('cytoBand', [], ['cytoBand'], 
+        lambda format: ann.CytobandStage(table='cytoBand', 
+            engine=overlapEngine(), format=format)),
+    ('gadAll', [], ['gadAll'], 
+        lambda format: ann.GadAllStage(table='gadAll', 
+            engine=overlapEngine(), format=format)),
+    ('gwasCatalog', [], ['gwasCatalog'], 
+        lambda format: ann.GwasCatalogStage(table='gwasCatalog', 
+            engine=overlapEngine(), format=format)),
+    ('miRNA', [], ['miRNAsites'], 
+        lambda format: ann.MiRNAStage(table='targetScanS', 
+            engine=overlapEngine(), format=format)),
+    ('hugo', [], ['HGNC_GeneAnnotation'], 
+        lambda format: ann.HugoStage(table='hugo', engine=overlapEngine(), 
+            format=format)),
+    ('CNV', [], ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+        'conrad_Cnv'], 
+        lambda format: ann.CnvTablesStage(tables=['dgv_Cnv', 
+            'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv'], 
+            engine=overlapEngine(), format=format)),
+    ('genomicSuperDups', [], ['genomicSuperDups', 'otherChrom', 
+        'otherStart', 'otherEnd'], 
+        lambda format: ann.GenomicSuperDupsStage(table='genomicSuperDups', 
+            engine=overlapEngine(), format=format)),
+    ('tfbsConsSites', [], ['tfbsRegion'], 
+        lambda format: ann.TfbsConsSitesStage(table='tfbsConsSites', 
+            engine=overlapEngine(), format=format)),
+]
+
+
+def overlapEngine():
+    return config.get('ann', 'OverlapEngine', fallback='sql')
+
+
+"""Stage names from a comma separated list (or a list)
+"""
+def stageNames(names):
+    if (names is None):
+        return []
+    if isinstance(names, str):
+        names = names.split(',')
+    return [str(name).strip() for name in names if str(name).strip() != '']
+
+
+"""The annotation stages, in registry order
+   The stages named in disabled (default: DisabledStages) are left out,
+   and so are the stages that read their annotations.
+"""
+def getStages(format='vcf', disabled=None):
+    if (disabled is None):
+        disabled = config.get('ann', 'DisabledStages', fallback='')
+    off = set(stageNames(disabled))
+    unknown = off - set([entry[0] for entry in STAGES])
+    if (len(unknown) > 0):
+        print(f"Ignoring unknown stages: {', '.join(sorted(unknown))}")
+
+    stages = []
+    seen = set()
+    for name, requires, produces, factory in STAGES:
+        for r in requires:
+            if (r not in seen):
+                raise ValueError(f"Stage {name} reads {r}, which is not " + \
+                    "registered before it")
+        seen.add(name)
+
+        missing = [r for r in requires if r in off]
+        if (name not in off and len(missing) > 0):
+            print(f"Skipping {name}: it reads the annotations of " + \
+                f"{', '.join(missing)}")
+            off.add(name)
+        if (name not in off):
+            stages.append(factory(format))
+    return stages
+
+
+"""The reference snapshot configured in ReferenceSnapshot, or None to
+   read the reference tables from the database
+"""
+def getSnapshot():
+    root = config.get('ann', 'ReferenceSnapshot', fallback='').strip()
+    if (root == ''):
+        return None
+    return snap.open_snapshot(root)
+
+
+"""The dbSNP filter configured in DbSnpFilter, or None
+   A filter built for another ReferenceVersion could rule out variants
+   that are in the current dbSNP, so it is not used.
+"""
+def getDbSnpFilter():
+    root = config.get('ann', 'DbSnpFilter', fallback='').strip()
+    if (root == ''):
+        return None
+    try:
+        dbsnp_filter = dbf.open_filter(root)
+    except (IOError, ValueError) as e:
+        print(f"Not using the dbSNP filter at {root}: {e}")
+        return None
+    version = config.get('ann', 'ReferenceVersion', fallback='')
+    if (dbsnp_filter.version != version):
+        print(f"Not using the dbSNP filter at {root}: built for " + \
+            f"{dbsnp_filter.version}, reference is {version} " + \
+            "(rebuild it with dbsnp_filter.py)")
+        return None
+    return dbsnp_filter
+
+
+"""The host-wide variant cache configured in VariantCache, or None
+   The cache version combines ReferenceVersion, the snapshot version and
+   the stage settings, so changing any of them starts a fresh keyspace.
+"""
+def getCache(stages, snapshot=None, format='vcf'):
+    path = config.get('ann', 'VariantCache', fallback='').strip()
+    if (path == ''):
+        return None
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    version = [config.get('ann', 'ReferenceVersion', fallback=''), format]
+    if (snapshot is not None):
+        version.append(snapshot.version)
+    version = version + [stage.signature() for stage in stages]
+
+    rewrites = []
+    for stage in stages:
+        rewrites = rewrites + stage.rewrites
+
+    return VariantCache(path, '|'.join(version), 
+        ann.getFormatSpecificIndices(format=format), rewrites=rewrites,
+        max_bytes=config.getint('ann', 'VariantCacheMaxMB', 
+            fallback=1024) * 1024 * 1024,
+        lru_size=config.getint('ann', 'VariantCacheLRUSize', 
+            fallback=100000))
+
+
+"""Runs each stage as a separate pass over the file, writing the
+   intermediate .1, .2, ... files
+"""
+def runStages(infile, stages, conn, snapshot=None, checkpoint=None):
+    tmpextin = 0
+    if (checkpoint is not None):
+        state = checkpoint.start('stages', stages)
+        if (state is not None):
+            tmpextin = resumeStages(infile, stages, state)
+
+    for stage in stages[tmpextin:]:
+        ann.runStage(stage, infile, 
+            tmpextin='' if (tmpextin == 0) else '.' + str(tmpextin), 
+            tmpextout='.' + str(tmpextin + 1), conn=conn, snapshot=snapshot)
+        print(f"{stage.name} - done.")
+        tmpextin = tmpextin + 1
+        if (checkpoint is not None):
+            out = infile + '.' + str(tmpextin)
+            checkpoint.save(out, ck.fileHash(out).hexdigest(), 
+                os.path.getsize(out), stage=tmpextin, 
+                counts=[s.counts for s in stages[:tmpextin]])
 
     ## Cleanup
     for i in range(1, tmpextin):
         fu.delete(infile + '.' + str(i))
 
     os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+
+
+"""Restores the counters of the stages a checkpointed run completed and
+   rewrites their part of the .count.log; returns how many there were
+"""
+def resumeStages(infile, stages, state):
+    done = state['stage']
+    fh_log = open(infile + '.count.log', 'w')
+    for i in range(0, done):
+        stages[i].mergeCounts(state['counts'][i])
+        stages[i].writeLog(fh_log)
+        print(f"{stages[i].name} - done (checkpoint).")
+    fh_log.close()
+    return done
+
+
+"""Annotates records in-process, lazily
+   records is any iterable of parsed records (lists of fields, in the
+   column order of format) or of raw lines, e.g. an open VCF file; header
+   lines are passed through unchanged. Yields the annotated records in
+   input order as lists of fields (and header lines as strings), reading
+   at most one block of records ahead, so memory stays bounded however
+   long the input is. Uses the stages of getStages() unless stages is
+   given, the configured reference snapshot or a pooled database
+   connection, and the configured variant cache. Once the records are
+   exhausted the stage counters (and cache counters) are written to
+   fh_log if given; they can also be read off the stages.
+"""
+def annotate_records(records, stages=None, format='vcf', sep='\t', 
+    fh_log=None):
+    if (stages is None):
+        stages = getStages(format=format)
+    snapshot = getSnapshot()
+    cache = getCache(stages, snapshot=snapshot, format=format)
+    try:
+        for item in annotateWith(records, stages, snapshot=snapshot, 
+            cache=cache, format=format, sep=sep):
+            yield item
+    finally:
+        if (cache is not None):
+            cache.close()
+
+    if (fh_log is not None):
+        for stage in stages:
+            stage.writeLog(fh_log)
+        if (cache is not None):
+            cache.writeLog(fh_log)
+
+
+"""annotateRecords() over the reference snapshot if there is one,
+   otherwise over a connection borrowed from the pool for the duration
+"""
+def annotateWith(records, stages, snapshot=None, cache=None, format='vcf',
+    sep='\t'):
+    if (snapshot is not None):
+        for item in ann.annotateRecords(records, stages, None, sep=sep,
+            snapshot=snapshot, cache=cache, format=format):
+            yield item
+    else:
+        # One connection per fetch thread
+        threads = max(1, min(config.getint('ann', 'FetchThreads', 
+            fallback=1), len(stages)))
+        with ExitStack() as stack:
+            cursors = [stack.enter_context(u.pooled_connection()).cursor()
+                for i in range(0, threads)]
+            for item in ann.annotateRecords(records, stages, 
+                cursors if (threads > 1) else cursors[0], sep=sep, 
+                cache=cache, format=format):
+                yield item
+
+
+"""Writes the records annotate_records() yields as tab-separated lines
+"""
+def writeRecords(items, fh_out):
+    for item in items:
+        if isinstance(item, str):
+            fh_out.write(item + '\n')
+        else:
+            fh_out.write('\t'.join(item) + '\n')
+
+
+"""Runs all stages in one streaming pass: the input is parsed once and
+   only the annotated file and the .count.log are written
+   With a checkpoint, progress is saved every interval input lines
+   (rounded up to whole blocks, where the stage counters match the lines
+   written) and a saved run continues after its last checkpoint.
+"""
+def runFused(infile, stages, format='vcf', checkpoint=None, interval=0):
+    snapshot = getSnapshot()
+    cache = getCache(stages, snapshot=snapshot, format=format)
+    state = None
+    if (checkpoint is not None):
+        state = checkpoint.start('fused', stages)
+
+    fh = open(infile)
+    if (state is None):
+        lines = 0
+        fh_out = open(infile + '.annot', 'w')
+    else:
+        lines = state['lines']
+        for i in range(0, len(stages)):
+            stages[i].mergeCounts(state['counts'][i])
+        if (cache is not None and state.get('cache_counts') is not None):
+            for k in state['cache_counts']:
+                cache.counts[k] = cache.counts.get(k, 0) + \
+                    state['cache_counts'][k]
+        fh_out = open(infile + '.annot', 'a')
+        print(f"Resuming after {lines} lines (checkpoint).")
+
+    try:
+        items = annotateWith(islice(fh, lines, None), stages, 
+            snapshot=snapshot, cache=cache, format=format)
+        if (checkpoint is None):
+            writeRecords(items, fh_out)
+        else:
+            writeCheckpointed(items, fh_out, stages, cache, checkpoint,
+                interval, lines)
+    finally:
+        if (cache is not None):
+            cache.close()
+    fh.close()
+    fh_out.close()
+
+    fh_log = open(infile + '.count.log', 'w')
+    for stage in stages:
+        stage.writeLog(fh_log)
+        print(f"{stage.name} - done.")
+    if (cache is not None):
+        cache.writeLog(fh_log)
+    fh_log.close()
+
+
+"""writeRecords() saving a checkpoint of a fused run after every interval
+   lines (rounded up to whole blocks); lines were written before
+"""
+def writeCheckpointed(items, fh_out, stages, cache, checkpoint, interval, 
+    lines):
+    block_size = ann.blockSize(stages)
+    every = max(1, -(-interval // block_size)) * block_size
+    digest = checkpoint.digest or ck.fileHash(fh_out.name)
+    n = 0
+    for item in items:
+        if isinstance(item, str):
+            line = item + '\n'
+        else:
+            line = '\t'.join(item) + '\n'
+        fh_out.write(line)
+        digest.update(line.encode(fh_out.encoding))
+        n = n + 1
+        if (n % every == 0):
+            fh_out.flush()
+            checkpoint.save(fh_out.name, digest.hexdigest(), 
+                os.fstat(fh_out.fileno()).st_size, lines=lines + n,
+                counts=[dict(stage.counts) for stage in stages],
+                cache_counts=dict(cache.counts) if (cache is not None) 
+                    else None)
+
+
+"""Yields (line, shard key) for every stripped line of the file; header
+   lines get None. Records are keyed by chromosome, or with
+   shard_by='range' by contiguous runs of size records.
+"""
+def shardKeys(fh, shard_by='chrom', size=1, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    rec = 0
+    for line in fh:
+        line = line.strip()
+        if ann.isHeader(line):
+            yield line, None
+            continue
+
+        if (shard_by == 'range'):
+            key = rec // size
+        else:
+            key = line.split(sep)[inds[0]].strip().replace('chr', '')
+        rec = rec + 1
+        yield line, key
+
+
+"""Annotates one shard file in a worker process with its own connection
+   (or the mapped reference snapshot, whose pages the workers share)
+   Returns the stage counters and the variant cache counters (or None) so
+   the parent can combine them
+"""
+def annotateShard(shard, format='vcf', disabled=None):
+    stages = getStages(format=format, disabled=disabled)
+    snapshot = getSnapshot()
+    cache = getCache(stages, snapshot=snapshot, format=format)
+    fh = open(shard)
+    fh_out = open(shard + '.annot', 'w')
+
+    try:
+        writeRecords(annotateWith(fh, stages, snapshot=snapshot, 
+            cache=cache, format=format), fh_out)
+    finally:
+        if (cache is not None):
+            cache.close()
+
+    fh.close()
+    fh_out.close()
+    return [stage.counts for stage in stages], \
+        cache.counts if (cache is not None) else None
+
+
+"""Splits the records into shards (by chromosome or into balanced ranges),
+   annotates the shards in a process pool and merges them back in the
+   original record order. Output and counters match a serial run.
+"""
+def runParallel(infile, stages, workers, shard_by='chrom', format='vcf',
+    disabled=None):
+    size = 1
+    if (shard_by == 'range'):
+        fh = open(infile)
+        total = len([line for line, key in shardKeys(fh, 'chrom', 
+            format=format) if key is not None])
+        fh.close()
+        size = max(1, -(-total // workers))
+
+    # Split
+    shards = {}
+    counts = {}
+    fh = open(infile)
+    for line, key in shardKeys(fh, shard_by, size, format=format):
+        if (key is None):
+            continue
+        if (key not in shards):
+            shards[key] = open(infile + '.shard' + str(len(shards)), 'w')
+            counts[key] = 0
+        shards[key].write(line + '\n')
+        counts[key] = counts[key] + 1
+    fh.close()
+
+    paths = {}
+    for key in shards:
+        paths[key] = shards[key].name
+        shards[key].close()
+
+    # Annotate, biggest shards first
+    cache_counts = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for key in sorted(paths, key=lambda k: counts[k], reverse=True):
+            futures[key] = pool.submit(annotateShard, paths[key], format,
+                disabled)
+        for key in futures:
+            shard_counts, shard_cache = futures[key].result()
+            for i in range(0, len(stages)):
+                stages[i].mergeCounts(shard_counts[i])
+            if (shard_cache is not None):
+                for k in shard_cache:
+                    cache_counts[k] = cache_counts.get(k, 0) + shard_cache[k]
+
+    # Merge back in the original order
+    outs = {}
+    for key in paths:
+        outs[key] = open(paths[key] + '.annot')
+    fh = open(infile)
+    fh_out = open(infile + '.annot', 'w')
+    for line, key in shardKeys(fh, shard_by, size, format=format):
+        if (key is None):
+            fh_out.write(line + '\n')
+        else:
+            fh_out.write(outs[key].readline())
+    fh.close()
+    fh_out.close()
+
+    for key in paths:
+        outs[key].close()
+        fu.delete(paths[key])
+        fu.delete(paths[key] + '.annot')
+
+    fh_log = open(infile + '.count.log', 'w')
+    for stage in stages:
+        stage.writeLog(fh_log)
+        print(f"{stage.name} - done.")
+    if (len(cache_counts) > 0):
+        writeCacheLog(fh_log, cache_counts)
+    fh_log.close()
+
+
+"""The checkpoint of a job on infile if checkpoints are enabled, copied
+   to the configured bucket under prefix (if any); job is kept in the
+   manifest so a restarted annotator can relaunch the job
+"""
+def getCheckpoint(infile, prefix='', job=None):
+    if not config.getboolean('ann', 'Checkpoints', fallback=False):
+        return None
+    return ck.Checkpoint(infile, 
+        bucket=config.get('s3', 'Checkpoint_Bucket', fallback='') or None,
+        prefix=prefix, job=job)
+
+
+"""Annotates infile into the .annot.vcf and .count.log next to it
+   disabled names stages to leave out for this job (default:
+   DisabledStages).
+"""
+def run(infile, format, fused=None, workers=None, checkpoint=None, 
+    disabled=None):
+
+    print("Running . . .")
+    if (fused is None):
+        fused = config.getboolean('ann', 'FusedPipeline', fallback=False)
+    if (workers is None):
+        workers = config.getint('ann', 'Workers', fallback=1)
+    if (workers > 1 and multiprocessing.current_process().daemon):
+        # A pooled annotator worker cannot start processes of its own
+        print("Running shards serially in a pooled worker")
+        workers = 1
+    if (checkpoint is None):
+        checkpoint = getCheckpoint(infile)
+
+    stages = getStages(format=format, disabled=disabled)
+    snapshot = getSnapshot()
+
+    if (workers > 1):
+        # Shards are not checkpointed
+        runParallel(infile, stages, workers, format=format,
+            shard_by=config.get('ann', 'ShardBy', fallback='chrom'),
+            disabled=disabled)
+    elif (fused):
+        runFused(infile, stages, format=format, checkpoint=checkpoint,
+            interval=config.getint('ann', 'CheckpointInterval', 
+            fallback=100000))
+    elif (snapshot is not None):
+        # No database connection needed
+        runStages(infile, stages, None, snapshot=snapshot, 
+            checkpoint=checkpoint)
+    else:
+        # One connection (and one secret lookup) shared by every stage
+        with u.pooled_connection() as conn:
+            runStages(infile, stages, conn, checkpoint=checkpoint)
+
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
+    if (checkpoint is not None):
+        checkpoint.clear()
 
 ### EOF
\ No newline at end of file
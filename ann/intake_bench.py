@@ -0,0 +1,117 @@
+# intake_bench.py
+#
+# Submit-to-start latency of the two job intake paths: SQS polling
+# (annotator.py) and SNS push (annotator_webhook.py). Run it on the annotator
+# instance, since the results are read from its status file. The annotator
+# only recognizes probes with IntakeProbes = yes in ann_config.ini
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import uuid
+import boto3
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'ann_config.ini'))
+
+# Attribute marking a probe (annotator.PROBE)
+PROBE = 'intake_probe'
+
+PATHS = ['webhook', 'sqs']
+
+
+"""Publishes n probes to the job requests topic, interval seconds apart
+   Each probe reaches the annotator through every intake path the topic
+   feeds; the annotator starts it like a job (on a pooled worker, without
+   running anything) and records the time since publishing in its status
+   file. Returns the probe ids.
+"""
+def publish(n, interval):
+    sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
+    run_id = uuid.uuid4().hex[:8]
+    ids = []
+    for i in range(0, n):
+        probe_id = f"{run_id}-{i}"
+        job = {PROBE: {'S': probe_id}, 'submit_time': {'N': str(time.time())}}
+        sns.publish(TopicArn=config['sns']['AWS_SNS_ARN_TOPIC'],
+            Message=json.dumps(job))
+        ids.append(probe_id)
+        time.sleep(interval)
+    return ids
+
+
+"""Latencies (seconds) of the probes by intake path, read from the
+   annotator's status file once every path has reported all of them (or
+   after timeout seconds)
+"""
+def collect(ids, status_file, timeout):
+    wanted = set(ids)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fh = open(status_file)
+            probes = json.load(fh).get('probes', [])
+            fh.close()
+        except (OSError, ValueError):
+            probes = []
+        latencies = {}
+        for probe in probes:
+            if (probe['id'] in wanted):
+                latencies.setdefault(probe['path'], []).append(
+                    probe['latency'])
+        if (len(latencies) == len(PATHS) and
+            min([len(v) for v in latencies.values()]) == len(ids)):
+            return latencies
+        if (time.time() > deadline):
+            return latencies
+        time.sleep(0.5)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main(n, interval, timeout):
+    status_file = config.get('annotator', 'StatusFile', fallback='')
+    if not status_file:
+        print("Set StatusFile in the [annotator] section of ann_config.ini")
+        sys.exit(1)
+    if not config.getboolean('annotator', 'IntakeProbes', fallback=False):
+        print("Set IntakeProbes = yes in the [annotator] section of " + \
+            "ann_config.ini (and restart the annotator)")
+        sys.exit(1)
+    latencies = collect(publish(n, interval), status_file, timeout)
+
+    print(f"{'path':10} {'probes':>7} {'mean (ms)':>10} {'p50 (ms)':>10} " + \
+        f"{'p95 (ms)':>10} {'max (ms)':>10}")
+    for path in PATHS:
+        values = latencies.get(path, [])
+        if (len(values) == 0):
+            print(f"{path:10} {0:>7}   (not running?)")
+            continue
+        print(f"{path:10} {len(values):>7} " + \
+            f"{1000 * sum(values) / len(values):10.1f} " + \
+            f"{1000 * percentile(values, 0.5):10.1f} " + \
+            f"{1000 * percentile(values, 0.95):10.1f} " + \
+            f"{1000 * max(values):10.1f}")
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']):
+        print("Usage: python intake_bench.py [probes] [interval (s)] " + \
+            "[timeout (s)]")
+        sys.exit(1)
+    args = sys.argv[1:] + ['50', '1', '120'][len(sys.argv) - 1:]
+    main(int(args[0]), float(args[1]), float(args[2]))
+
+### EOF
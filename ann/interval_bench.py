@@ -0,0 +1,111 @@
+# interval_bench.py
+#
+# Micro-benchmark of the scalar interval helpers in utils against NumPy
+# batch versions of them (utils.isBetweenBatch and the ones below)
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import numpy as np
+
+import utils as u
+
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+# The scalar loops convert this many intervals to Python ints at a time
+CHUNK = 10**6
+
+
+"""n random test and reference intervals (starts within 1Mb, lengths up
+   to 10kb)
+"""
+def intervals(n, seed=0):
+    rng = np.random.default_rng(seed)
+    testStarts = rng.integers(0, 1000000, n)
+    testEnds = testStarts + rng.integers(0, 10000, n)
+    refStarts = rng.integers(0, 1000000, n)
+    refEnds = refStarts + rng.integers(0, 10000, n)
+    return testStarts, testEnds, refStarts, refEnds
+
+
+def scalar(name, a, b, c, d):
+    results = []
+    for lo in range(0, len(a), CHUNK):
+        ts, te, rs, re = [x[lo:lo + CHUNK].tolist() for x in [a, b, c, d]]
+        if (name == 'isBetween'):
+            results.extend([u.isBetween(ts[i], rs[i], re[i]) 
+                for i in range(0, len(ts))])
+        else:
+            f = getattr(u, name)
+            results.extend([f(ts[i], te[i], rs[i], re[i]) 
+                for i in range(0, len(ts))])
+    return results
+
+
+"""Batch versions of the overlap helpers; the stages find overlapping rows
+   through the interval indexes, so only the benchmark uses them
+"""
+def isOverlapBatch(testStarts, testEnds, refStarts, refEnds):
+    return (((testStarts <= refStarts) & (testEnds >= refStarts)) |
+        ((testStarts >= refStarts) & (testStarts <= refEnds)))
+
+
+def getOverlapBatch(testStarts, testEnds, refStarts, refEnds):
+    return np.maximum(0, np.minimum(testEnds, refEnds) - 
+        np.maximum(testStarts, refStarts) + 1)
+
+
+def proportionOverlapBatch(testStarts, testEnds, refStarts, refEnds):
+    cnvlength = (testEnds - testStarts) + 1
+    overlaplength = getOverlapBatch(testStarts, testEnds, refStarts, refEnds)
+    return np.round((overlaplength / cnvlength.astype(np.float64)) * 100, 2)
+
+
+BATCH = {'isOverlap': isOverlapBatch, 'getOverlap': getOverlapBatch,
+    'proportionOverlap': proportionOverlapBatch}
+
+
+def batch(name, a, b, c, d):
+    if (name == 'isBetween'):
+        return u.isBetweenBatch(a, c, d)
+    return BATCH[name](a, b, c, d)
+
+
+"""Intervals per second for f over the arrays (best of three for small
+   sizes)
+"""
+def throughput(f, name, arrays, repeat):
+    best = None
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        f(name, *arrays)
+        elapsed = time.perf_counter() - start
+        best = elapsed if (best is None) else min(best, elapsed)
+    return len(arrays[0]) / best
+
+
+def main(sizes):
+    print(f"{'function':18} {'n':>10} {'scalar (/s)':>14} " + \
+        f"{'batch (/s)':>14} {'speedup':>8}")
+    for n in sizes:
+        arrays = intervals(n)
+        repeat = 3 if (n <= 10**5) else 1
+        for name in ['isOverlap', 'getOverlap', 'proportionOverlap',
+            'isBetween']:
+            fast = throughput(batch, name, arrays, repeat)
+            slow = throughput(scalar, name, arrays, repeat)
+            print(f"{name:18} {n:>10} {slow:14.0f} {fast:14.0f} " + \
+                f"{fast / slow:7.1f}x")
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']):
+        print("Usage: python interval_bench.py [n ...]")
+        sys.exit(1)
+    main([int(float(n)) for n in sys.argv[1:]] or SIZES)
+
+### EOF
@@ -0,0 +1,251 @@
+# interval_index.py
+#
+# In-memory point-overlap index over the annotator reference tables
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+import numpy as np
+import pymysql
+
+import queries as q
+
+
+"""Sorted interval arrays for one chromosome of a reference table
+   starts/ends are sorted by start, maxends is the running maximum of
+   ends (so the first interval that can still reach a position is a
+   binary search away) and order maps back to the table row order.
+   Pre-sorted arrays (order, maxends) can be passed in, e.g. from a
+   memory-mapped snapshot.
+"""
+class ChromIntervals(object):
+    def __init__(self, rows, starts, ends, order=None, maxends=None):
+        self.rows = rows
+        if (order is None):
+            order = np.argsort(starts, kind='stable')
+            starts = starts[order]
+            ends = ends[order]
+            maxends = np.maximum.accumulate(ends) if \
+                (len(ends) > 0) else ends
+        self.order = order
+        self.starts = starts
+        self.ends = ends
+        self.maxends = maxends
+
+    """Row indices (in table order) of intervals with start <= end and
+       pos <= interval end, i.e. overlapping [pos, end] (default: pos)
+    """
+    def overlapping(self, pos, end=None):
+        if (end is None):
+            end = pos
+        hi = np.searchsorted(self.starts, end, side='right')
+        lo = np.searchsorted(self.maxends, pos, side='left')
+        if (lo >= hi):
+            return []
+        hits = lo + np.nonzero(self.ends[lo:hi] >= pos)[0]
+        return np.sort(self.order[hits]).tolist()
+
+
+"""Select list for loading an index: the requested columns followed by the
+   interval columns (and any extra columns), which the rows are trimmed of
+   again (width)
+"""
+def selectList(columns, start_col, end_col, extra=[]):
+    if (columns == '*'):
+        return columns, None
+    width = len(columns.split(','))
+    return ', '.join([columns, start_col, end_col] + list(extra)), width
+
+
+"""Point-overlap index over a reference table, loaded once per chromosome
+   Answers the same question as
+     select <columns> from <table> where <chrom_col>=chrom
+       AND <start_col> <= pos AND pos <= <end_col>
+   and returns the rows in the order the table scan would.
+   If chrom_col is None the table is split per chromosome and named
+   <table><chrom> (e.g. tfbsConsSites1).
+"""
+class IntervalIndex(object):
+    def __init__(self, cursor, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*'):
+        self.cursor = cursor
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.chroms = {}
+
+    def load(self, chrom):
+        select, width = selectList(self.columns, self.start_col, self.end_col)
+        if (self.chrom_col is None):
+            sql = 'select ' + select + ' from ' + self.table + \
+                str(chrom) + ';'
+            self.cursor.execute(sql)
+        else:
+            sql = 'select ' + select + ' from ' + self.table + \
+                ' where ' + self.chrom_col + '=%s;'
+            self.cursor.execute(sql, (chrom,))
+        rows = self.cursor.fetchall()
+
+        names = [str(d[0]) for d in self.cursor.description]
+        start_ind = names.index(self.start_col)
+        end_ind = names.index(self.end_col)
+        starts = np.array([int(r[start_ind]) for r in rows], dtype=np.int64)
+        ends = np.array([int(r[end_ind]) for r in rows], dtype=np.int64)
+        if (width is not None):
+            rows = [r[:width] for r in rows]
+
+        intervals = ChromIntervals(rows, starts, ends)
+        self.chroms[chrom] = intervals
+        return intervals
+
+    def get(self, chrom):
+        intervals = self.chroms.get(chrom)
+        if (intervals is None):
+            intervals = self.load(chrom)
+        return intervals
+
+    """All rows overlapping pos, like cursor.fetchall()
+    """
+    def overlapping(self, chrom, pos):
+        intervals = self.get(chrom)
+        return [intervals.rows[i] for i in intervals.overlapping(int(pos))]
+
+    """First row overlapping pos or None, like cursor.fetchone()
+    """
+    def first(self, chrom, pos):
+        intervals = self.get(chrom)
+        hits = intervals.overlapping(int(pos))
+        if (len(hits) > 0):
+            return intervals.rows[hits[0]]
+        return None
+
+    def close(self):
+        self.chroms = {}
+
+
+"""Raised by SweepIndex when it cannot answer a lookup: positions arrive
+   out of order, or the table has no primary key to order rows by
+"""
+class UnsortedInputError(Exception):
+    pass
+
+
+"""Sweep-line (sorted merge-join) overlap lookups for sorted input
+   For each chromosome the table rows are streamed in start order through
+   an unbuffered server-side cursor on a dedicated connection, and the
+   intervals that can still overlap are kept in a heap keyed by end. Each
+   chromosome therefore costs one sequential scan instead of one probe
+   per variant. Positions must be queried in (chromosome, position)
+   order; otherwise UnsortedInputError is raised and the caller should go
+   back to per-variant queries. Rows are streamed in (start, primary key)
+   order and overlapping rows come back in primary key order, the order
+   of a table scan, so first() picks the same row as the other engines.
+   key is the primary key of the table (looked up per chromosome table
+   when the table is split); a table without one raises
+   UnsortedInputError.
+"""
+class SweepIndex(object):
+    def __init__(self, conn, table, chrom_col='chrom', 
+        start_col='chromStart', end_col='chromEnd', columns='*', key=None):
+        self.conn = conn
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.key = key
+        self.cursor = None
+        self.chrom = None
+        self.done = set()
+        self.pos = None
+        self.active = []
+        self.pending = None
+
+    def scan(self, chrom):
+        self.finish()
+        table = self.table
+        key = self.key
+        if (self.chrom_col is None):
+            table = self.table + str(chrom)
+            key = q.primaryKey(self.conn.cursor(), table)
+        if (key is None):
+            raise UnsortedInputError(f"{table} has no primary key")
+
+        select, self.width = selectList(self.columns, self.start_col, 
+            self.end_col, extra=key)
+        order = ' order by ' + ', '.join([self.start_col] + key) + ';'
+        if (self.chrom_col is None):
+            sql = 'select ' + select + ' from ' + table + order
+            args = None
+        else:
+            sql = 'select ' + select + ' from ' + table + \
+                ' where ' + self.chrom_col + '=%s' + order
+            args = (chrom,)
+        self.cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        self.cursor.execute(sql, args)
+
+        names = [str(d[0]) for d in self.cursor.description]
+        self.start_ind = names.index(self.start_col)
+        self.end_ind = names.index(self.end_col)
+        # The key columns appended last (or found in select *)
+        if (self.width is None):
+            self.key_inds = [names.index(k) for k in key]
+        else:
+            self.key_inds = list(range(len(names) - len(key), len(names)))
+        self.chrom = chrom
+        self.pos = None
+        self.active = []
+        self.pending = self.cursor.fetchone()
+
+    def finish(self):
+        if (self.cursor is not None):
+            self.cursor.close()
+            self.cursor = None
+        if (self.chrom is not None):
+            self.done.add(self.chrom)
+
+    def overlapping(self, chrom, pos):
+        pos = int(pos)
+        if (chrom != self.chrom):
+            if (chrom in self.done):
+                raise UnsortedInputError(f"{self.table}: {chrom} revisited")
+            self.scan(chrom)
+        elif (pos < self.pos):
+            raise UnsortedInputError(f"{self.table}: {chrom}:{pos} after " + \
+                f"{chrom}:{self.pos}")
+        self.pos = pos
+
+        # Admit every interval that starts at or before pos
+        while (self.pending is not None and 
+            int(self.pending[self.start_ind]) <= pos):
+            row = self.pending
+            end = int(row[self.end_ind])
+            key = tuple([row[i] for i in self.key_inds])
+            if (self.width is not None):
+                row = row[:self.width]
+            heapq.heappush(self.active, (end, key, row))
+            self.pending = self.cursor.fetchone()
+
+        # Retire every interval that ends before pos
+        while (len(self.active) > 0 and self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [row for end, key, row in sorted(self.active, 
+            key=lambda a: a[1])]
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def close(self):
+        self.finish()
+        self.active = []
+
+### EOF
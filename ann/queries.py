@@ -0,0 +1,111 @@
+# queries.py
+#
+# Parameterized reference lookups used by the annotation stages
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pymysql
+
+import utils as u
+
+"""Statement templates. {columns} is the projection a stage reads, the
+   other {names} are table and column names filled in once per table by
+   prepare(); values are always passed as parameters.
+"""
+DBSNP = 'select {columns} from dbSNP where CHR=%s AND POS=%s ' + \
+    'AND REF IN (%s, %s) AND INFO=%s;'
+
+DBSNP_BLOCK = 'select POS, REF, {columns} from dbSNP where CHR=%s ' + \
+    'AND INFO=%s AND POS IN ({positions});'
+
+# (txStart - offset) <= pos <= (txEnd + offset), written so that the
+# columns are compared directly
+GENES = 'select {columns} from {table} where chrom=%s ' + \
+    'AND txStart <= %s AND %s <= txEnd{bins};'
+
+OVERLAP = 'select {columns} from {table} where {chrom_col}=%s ' + \
+    'AND {start_col} <= %s AND %s <= {end_col}{bins};'
+
+# Tables split per chromosome (no chromosome column)
+OVERLAP_SPLIT = 'select {columns} from {table} ' + \
+    'where {start_col} <= %s AND %s <= {end_col}{bins};'
+
+# One flag per table in a combined overlap test ('select <exists>, ...')
+EXISTS = 'exists(select 1 from {table} where {chrom_col}=%s ' + \
+    'AND {start_col} <= %s AND %s <= {end_col}{bins})'
+
+
+_columns = {}
+_keys = {}
+
+"""Column names of a table in table order (read once per process)
+"""
+def tableColumns(cursor, table):
+    if (table not in _columns):
+        cursor.execute('select * from ' + table + ' limit 0;')
+        _columns[table] = [str(d[0]) for d in cursor.description]
+    return _columns[table]
+
+
+"""Primary key columns of a table in key order (read once per process),
+   or None if it has no primary key
+"""
+def primaryKey(cursor, table):
+    if (table not in _keys):
+        try:
+            cursor.execute('show keys from ' + table + 
+                " where Key_name = 'PRIMARY';")
+        except pymysql.err.MySQLError:
+            _keys[table] = None
+            return None
+        names = [str(d[0]) for d in cursor.description]
+        seq = names.index('Seq_in_index')
+        col = names.index('Column_name')
+        rows = sorted(cursor.fetchall(), key=lambda r: int(r[seq]))
+        _keys[table] = [str(r[col]) for r in rows] or None
+    return _keys[table]
+
+
+"""True if the table has a UCSC bin column
+"""
+def hasBinColumn(cursor, table):
+    return 'bin' in [c.lower() for c in tableColumns(cursor, table)]
+
+
+"""Comma separated names of the columns at the given positions (the row
+   indices a stage used to read from select *)
+"""
+def projection(names, positions):
+    return ', '.join([names[i] for i in positions])
+
+
+"""Fills in the names of a statement template, keeping the {bins} and
+   {positions} placeholders that depend on the lookup
+"""
+def prepare(template, **names):
+    names.setdefault('bins', '{bins}')
+    names.setdefault('positions', '{positions}')
+    return template.format(**names)
+
+
+"""Bin predicate and its parameters for rows overlapping [start, end]
+   (see utils.binPredicate); empty if the table has no bin column
+"""
+def binArgs(cursor, table, start, end):
+    if not hasBinColumn(cursor, table):
+        return '', []
+    bins = u.binsForRange(int(start) - 1, int(end) + 1)
+    return ' AND bin IN (' + ','.join(['%s'] * len(bins)) + ')', bins
+
+
+"""Runs a prepared statement that has a {bins} placeholder for the rows
+   overlapping [start, end]
+"""
+def executeBinned(cursor, sql, table, args, start, end):
+    clause, bins = binArgs(cursor, table, start, end)
+    cursor.execute(sql.replace('{bins}', clause), list(args) + bins)
+
+### EOF
@@ -0,0 +1,164 @@
+# ref_indexes.py
+#
+# Checks and adds the (chrom, bin) indexes used by the binned range queries
+# of the annotator, and reports query times with and without them
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import random
+
+import utils as u
+from snapshot import TABLES, SPLIT_CHROMS
+
+SAMPLE_SIZE = 20
+
+
+"""Every table the annotator queries, as (table, chromosome column,
+   start column, end column); per-chromosome tables are listed one by one
+   with no chromosome column
+"""
+def annotatorTables():
+    tables = []
+    for table in sorted(TABLES):
+        chrom_col, start_col, end_col = TABLES[table]
+        if (chrom_col is None):
+            for chrom in SPLIT_CHROMS:
+                tables.append((table + chrom, None, start_col, end_col))
+        else:
+            tables.append((table, chrom_col, start_col, end_col))
+    return tables
+
+
+def tableExists(cursor, table):
+    cursor.execute('show tables like %s;', (table,))
+    return cursor.fetchone() is not None
+
+
+def hasBin(cursor, table):
+    cursor.execute('show columns from ' + table + ' like %s;', ('bin',))
+    return cursor.fetchone() is not None
+
+
+"""Columns the binned queries need indexed: (chrom, bin), or just bin for
+   per-chromosome tables
+"""
+def wantedIndex(chrom_col):
+    return ['bin'] if (chrom_col is None) else [chrom_col.lower(), 'bin']
+
+
+"""True if some index of the table starts with the wanted columns
+"""
+def hasIndex(cursor, table, columns):
+    cursor.execute('show index from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    key_ind = names.index('Key_name')
+    seq_ind = names.index('Seq_in_index')
+    col_ind = names.index('Column_name')
+
+    keys = {}
+    for row in cursor.fetchall():
+        keys.setdefault(row[key_ind], {})[int(row[seq_ind])] = \
+            str(row[col_ind]).lower()
+    for key in keys:
+        cols = [keys[key][seq] for seq in sorted(keys[key])]
+        if (cols[:len(columns)] == columns):
+            return True
+    return False
+
+
+def addIndex(cursor, table, chrom_col):
+    columns = wantedIndex(chrom_col)
+    sql = 'alter table ' + table + ' add index ' + table + '_' + \
+        '_'.join(columns) + ' (' + ', '.join(columns) + ');'
+    print(sql)
+    cursor.execute(sql)
+
+
+"""Average query time (ms) for SAMPLE_SIZE positions taken from the table,
+   without and with the bin predicate
+"""
+def timeQueries(cursor, table, chrom_col, start_col, end_col):
+    cursor.execute('select ' + (chrom_col or "''") + ', ' + start_col + \
+        ' from ' + table + ' limit 1000;')
+    rows = list(cursor.fetchall())
+    if (len(rows) == 0):
+        return None, None
+    sample = random.sample(rows, min(SAMPLE_SIZE, len(rows)))
+
+    times = []
+    for binned in [False, True]:
+        elapsed = 0.0
+        for chrom, pos in sample:
+            sql = 'select SQL_NO_CACHE * from ' + table + ' where ' + \
+                start_col + ' <= ' + str(pos) + ' AND ' + str(pos) + \
+                ' <= ' + end_col
+            if (chrom_col is not None):
+                sql = sql + ' AND ' + chrom_col + '="' + str(chrom) + '"'
+            if (binned):
+                sql = sql + ' AND ' + u.binPredicate(pos, pos)
+            start = time.time()
+            cursor.execute(sql + ';')
+            cursor.fetchall()
+            elapsed = elapsed + (time.time() - start)
+        times.append(elapsed * 1000 / len(sample))
+    return times[0], times[1]
+
+
+def report(cursor, tables):
+    print(f"{'table':40} {'no bin (ms)':>12} {'bin IN (ms)':>12}")
+    for table, chrom_col, start_col, end_col in tables:
+        plain, binned = timeQueries(cursor, table, chrom_col, start_col,
+            end_col)
+        if (plain is not None):
+            print(f"{table:40} {plain:12.2f} {binned:12.2f}")
+
+
+"""check: list the tables and whether they have a bin column and index
+   add: add the missing indexes, with a query time report before and after
+   report: query times with and without the bin predicate
+"""
+def main(command):
+    with u.pooled_connection() as conn:
+        cursor = conn.cursor()
+        binned = []
+        for table, chrom_col, start_col, end_col in annotatorTables():
+            if not tableExists(cursor, table):
+                continue
+            if not hasBin(cursor, table):
+                print(f"{table}: no bin column")
+                continue
+            indexed = hasIndex(cursor, table, wantedIndex(chrom_col))
+            print(f"{table}: bin column, " + \
+                f"({', '.join(wantedIndex(chrom_col))}) index " + \
+                ("present" if indexed else "MISSING"))
+            binned.append((table, chrom_col, start_col, end_col, indexed))
+
+        tables = [b[:4] for b in binned]
+        if (command == 'report'):
+            report(cursor, tables)
+        elif (command == 'add'):
+            missing = [b for b in binned if not b[4]]
+            if (len(missing) == 0):
+                print("All indexes present")
+                return
+            print("Before:")
+            report(cursor, [b[:4] for b in missing])
+            for table, chrom_col, start_col, end_col, indexed in missing:
+                addIndex(cursor, table, chrom_col)
+            conn.commit()
+            print("After:")
+            report(cursor, [b[:4] for b in missing])
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) != 2 or sys.argv[1] not in ['check', 'add', 'report']):
+        print("Usage: python ref_indexes.py check|add|report")
+        sys.exit(1)
+    main(sys.argv[1])
+
+### EOF
@@ -12,6 +12,7 @@ import os
 import sys
 import time
 import driver
+import utils as u
 import shutil
 import json
 import logging
@@ -46,118 +47,163 @@ def current_epoch_time():
 
 cnet_id = 'songyuanzheng'
 
-def main():
-    config = ConfigParser(os.environ)
-    config.read('ann_config.ini')
-    region = config['aws']['AwsRegionName']
-    bucket_name = config['s3']['Result_Bucket']
+config = ConfigParser(os.environ)
+config.read('ann_config.ini')
+
+# AWS clients, created once per process (a pooled annotator worker
+# reuses them for every job it runs)
+_clients = {}
+
+def aws_client(name):
+    if name not in _clients:
+        _clients[name] = boto3.client(name,
+            region_name=config['aws']['AwsRegionName'])
+    return _clients[name]
+
+
+"""Warms up a long-lived worker process before its first job: the AWS
+   clients, a pooled database connection per fetch thread, and the
+   reference snapshot and dbSNP filter (if configured)
+"""
+def warm_up():
+    # Workers forked from a parent that made AWS calls must not share its
+    # clients' connections
+    _clients.clear()
+    for name in ['s3', 'dynamodb', 'sns', 'stepfunctions']:
+        aws_client(name)
+    snapshot = driver.getSnapshot()
+    driver.getDbSnpFilter()
+    if snapshot is None:
+        manager = u.get_connection_manager()
+        conns = []
+        try:
+            for i in range(config.getint('ann', 'FetchThreads', fallback=1)):
+                conns.append(manager.acquire())
+        except Exception as e:
+            logging.error(e)
+        for conn in conns:
+            manager.release(conn)
 
 
+"""Annotates one job's input file, uploads the results and log, updates
+   the job item, and notifies the user and the archive workflow
+"""
+def run_job(file_path, job_id, user_id, disabled=None):
+    bucket_name = config['s3']['Result_Bucket']
 
     # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-        # python Annotools/run.py {filepath}
-        file_path = sys.argv[1]
-        job_id = sys.argv[2]
-        user_id = sys.argv[3]
-        # "annotation_jobs/{annotation_job_id}/{filename}"
-        arr = file_path.split('/')
-        folder_path = f"annotation_jobs/{job_id}"
-        input_file = arr[2]
-        client = boto3.resource('s3', region_name=region)
-        key_result_file, key_log_file = '', ''
-        # 1. Upload the results file to S3 results bucket
-        # 2. Upload the log file to S3 results bucket
-        for _, _, files in os.walk(folder_path):
-            for file in files:
-                if file == input_file:
-                    continue
-                key = f'{cnet_id}/{user_id}/{job_id}/{file}'
-                cur_file_path = f'{folder_path}/{file}'
-                if file.endswith('.annot.vcf'):
-                    key_result_file = key
-                if file.endswith('.log'):
-                    key_log_file = key
-                try:
-                    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
-                    # Example of upload files
-                    client.meta.client.upload_file(cur_file_path, bucket_name, key)
-                except ClientError as e:
-                    logging.error(e)
-                    print(e)
-                    exit(1)
-        # 3. Clean up (delete) local job files
-        try: 
-            shutil.rmtree(folder_path)
-        except OSError as e:
-            print("Error while removing job directory: %s - %s." % (e.filename, e.strerror))
-        # 4. Update 
-        dynamoDB = boto3.client('dynamodb', region_name=region)
-        update_exp = 'SET s3_results_bucket = :bucket, s3_key_result_file = :result_file, ' \
-                     's3_key_log_file = :log_file, complete_time = :time, job_status = :status'
-        try:
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
-            # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.SET
-            # Examples of AttributeUpdates
-            dynamoDB.update_item(TableName="songyuanzheng_annotations",
-                                 Key={'job_id': {'S': job_id}},
-                                 UpdateExpression=update_exp,
-                                 ExpressionAttributeValues={
-                                     ':bucket': {'S': bucket_name},
-                                     ':result_file': {'S': key_result_file},
-                                     ':log_file': {'S': key_log_file},
-                                     ':time': {'N': str(current_epoch_time())},
-                                     ':status': {'S': 'COMPLETED'}
-                                 })
-        except ClientError as error:
-            logging.error(e)
-            print(error)
-        # 5. publish a notification that job is finished
-        msg = {
-            'user_id': user_id,
-            'job_id': job_id,
-            'complete_time': str(current_epoch_time())
-        }
-        sns = boto3.client('sns', region_name=region)
-        try:
-            sns.publish(
-                TopicArn=config['sns']['AWS_SNS_ARN_TOPIC'],
-                Message=json.dumps(msg)
-            )
-        except ClientError as e:
-            print(f'Fail to post message to sns: {e}')
-        # 6. trigger data archive for free users
-        msg = {
-            'bucket': bucket_name,
-            'filename': key_result_file,
-            'user_id': user_id,
-            'job_id': job_id
+    # Resumes from the job's last checkpoint, if any (locally or in S3)
+    checkpoint = driver.getCheckpoint(file_path,
+        prefix=f'{cnet_id}/checkpoints/{job_id}/',
+        job={'job_id': job_id, 'user_id': user_id,
+             'disabled_stages': disabled})
+    with Timer():
+        driver.run(file_path, 'vcf', checkpoint=checkpoint,
+                   disabled=disabled)
+    # "annotation_jobs/{annotation_job_id}/{filename}"
+    arr = file_path.split('/')
+    folder_path = f"annotation_jobs/{job_id}"
+    input_file = arr[2]
+    client = aws_client('s3')
+    key_result_file, key_log_file = '', ''
+    # 1. Upload the results file to S3 results bucket
+    # 2. Upload the log file to S3 results bucket
+    for _, _, files in os.walk(folder_path):
+        for file in files:
+            if file == input_file:
+                continue
+            key = f'{cnet_id}/{user_id}/{job_id}/{file}'
+            cur_file_path = f'{folder_path}/{file}'
+            if file.endswith('.annot.vcf'):
+                key_result_file = key
+            if file.endswith('.log'):
+                key_log_file = key
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
+                # Example of upload files
+                client.upload_file(cur_file_path, bucket_name, key)
+            except ClientError as e:
+                logging.error(e)
+                print(e)
+                return False
+    # 3. Clean up (delete) local job files
+    try: 
+        shutil.rmtree(folder_path)
+    except OSError as e:
+        print("Error while removing job directory: %s - %s." % (e.filename, e.strerror))
+    # 4. Update 
+    dynamoDB = aws_client('dynamodb')
+    update_exp = 'SET s3_results_bucket = :bucket, s3_key_result_file = :result_file, ' \
+                 's3_key_log_file = :log_file, complete_time = :time, job_status = :status'
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
+        # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.SET
+        # Examples of AttributeUpdates
+        dynamoDB.update_item(TableName="songyuanzheng_annotations",
+                             Key={'job_id': {'S': job_id}},
+                             UpdateExpression=update_exp,
+                             ExpressionAttributeValues={
+                                 ':bucket': {'S': bucket_name},
+                                 ':result_file': {'S': key_result_file},
+                                 ':log_file': {'S': key_log_file},
+                                 ':time': {'N': str(current_epoch_time())},
+                                 ':status': {'S': 'COMPLETED'}
+                             })
+    except ClientError as error:
+        logging.error(error)
+        print(error)
+    # 5. publish a notification that job is finished
+    msg = {
+        'user_id': user_id,
+        'job_id': job_id,
+        'complete_time': str(current_epoch_time())
+    }
+    sns = aws_client('sns')
+    try:
+        sns.publish(
+            TopicArn=config['sns']['AWS_SNS_ARN_TOPIC'],
+            Message=json.dumps(msg)
+        )
+    except ClientError as e:
+        print(f'Fail to post message to sns: {e}')
+    # 6. trigger data archive for free users
+    msg = {
+        'bucket': bucket_name,
+        'filename': key_result_file,
+        'user_id': user_id,
+        'job_id': job_id
+    }
+    data = {
+        'seconds': config['sfn']['AVAILABLE_TIME'],
+        'notification': {
+            'topic': config['sns']['SNS_ARCHIVE_TOPIC'],
+            'message': json.dumps(msg)
         }
-        data = {
-            'seconds': config['sfn']['AVAILABLE_TIME'],
-            'notification': {
-                'topic': config['sns']['SNS_ARCHIVE_TOPIC'],
-                'message': json.dumps(msg)
-            }
-        }
-        # Ref:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions.html#SFN.Client.start_execution
-        # https://hands-on.cloud/working-with-step-functions-in-python-using-boto3/#h-execute-step-functions-workflow
-        # https://hands-on.cloud/aws-step-functions-tutorial/
-        # Examples from the code of step functions
-        sfn = boto3.client('stepfunctions', region_name=config['aws']['AwsRegionName'])
-        try:
-            sfn.start_execution(
-                stateMachineArn=config['sfn']['ARCHIVE_STEP_FUNCTION'],
-                name=job_id,
-                input=json.dumps(data)
-            )
-        except ClientError as e:
-            print(f'Fail to trigger step function: {e}')
+    }
+    # Ref:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions.html#SFN.Client.start_execution
+    # https://hands-on.cloud/working-with-step-functions-in-python-using-boto3/#h-execute-step-functions-workflow
+    # https://hands-on.cloud/aws-step-functions-tutorial/
+    # Examples from the code of step functions
+    sfn = aws_client('stepfunctions')
+    try:
+        sfn.start_execution(
+            stateMachineArn=config['sfn']['ARCHIVE_STEP_FUNCTION'],
+            name=job_id,
+            input=json.dumps(data)
+        )
+    except ClientError as e:
+        print(f'Fail to trigger step function: {e}')
+    return True
 
 
+def main():
+    if len(sys.argv) > 3:
+        # python Annotools/run.py {filepath} {job_id} {user_id} [stages]
+        # Optional: comma separated stages this job does not need
+        disabled = sys.argv[4] if len(sys.argv) > 4 else None
+        if not run_job(sys.argv[1], sys.argv[2], sys.argv[3], disabled):
+            exit(1)
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
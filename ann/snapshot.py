@@ -0,0 +1,335 @@
+# snapshot.py
+#
+# Offline, memory-mapped snapshot of the annotator reference tables
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import os
+import json
+import shutil
+import time
+import numpy as np
+import pymysql
+
+import utils as u
+from interval_index import ChromIntervals
+
+"""Tables exported by the builder: (chromosome column, interval start
+   column, interval end column). Point lookups (dbSNP, the equal bigRefGene
+   tables, gwasCatalog) use the same column for start and end. A None
+   chromosome column means the table is split per chromosome and named
+   <table><chrom>.
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+    'tfbsConsSites': (None, 'chromStart', 'chromEnd'),
+}
+
+SPLIT_CHROMS = [str(c) for c in range(1, 23)] + ['X', 'Y']
+
+MANIFEST = 'snapshot.json'
+
+
+"""Column kind for a list of values: 'int' and 'float' are stored as
+   arrays (no NULLs allowed), 'bytes' and 'str' as ids into the string heap
+"""
+def columnKind(values):
+    kinds = set([type(v) for v in values])
+    if (kinds == set([int])):
+        return 'int'
+    if (kinds == set([float])):
+        return 'float'
+    if (kinds <= set([bytes, type(None)]) and bytes in kinds):
+        return 'bytes'
+    return 'str'
+
+
+"""Writes one chromosome of a table: a .npy array per column, the interned
+   string heap and the start-sorted interval arrays
+"""
+def writeChrom(path, names, columns, start_col, end_col):
+    os.makedirs(path)
+    heap = []
+    offsets = [0]
+    interned = {}
+    kinds = []
+
+    for i in range(0, len(names)):
+        values = columns[i]
+        kind = columnKind(values)
+        kinds.append(kind)
+        if (kind == 'int'):
+            arr = np.array(values, dtype=np.int64)
+        elif (kind == 'float'):
+            arr = np.array(values, dtype=np.float64)
+        else:
+            ids = []
+            for v in values:
+                if (v is None):
+                    ids.append(-1)
+                    continue
+                data = v if (kind == 'bytes') else str(v).encode('utf-8')
+                sid = interned.get(data)
+                if (sid is None):
+                    sid = len(interned)
+                    interned[data] = sid
+                    heap.append(data)
+                    offsets.append(offsets[-1] + len(data))
+                ids.append(sid)
+            arr = np.array(ids, dtype=np.int32)
+        np.save(os.path.join(path, 'col' + str(i) + '.npy'), arr)
+
+    np.save(os.path.join(path, 'strings.npy'),
+        np.frombuffer(b''.join(heap), dtype=np.uint8))
+    np.save(os.path.join(path, 'offsets.npy'),
+        np.array(offsets, dtype=np.int64))
+
+    starts = np.array([int(v) for v in columns[names.index(start_col)]],
+        dtype=np.int64)
+    ends = np.array([int(v) for v in columns[names.index(end_col)]],
+        dtype=np.int64)
+    intervals = ChromIntervals(None, starts, ends)
+    for a in ['order', 'starts', 'ends', 'maxends']:
+        np.save(os.path.join(path, a + '.npy'), getattr(intervals, a))
+
+    return kinds
+
+
+"""Exports one table, chromosome by chromosome, streaming the rows
+   through a server-side cursor
+"""
+def buildTable(conn, root, table):
+    chrom_col, start_col, end_col = TABLES[table]
+    cursor = conn.cursor()
+    if (chrom_col is None):
+        chroms = SPLIT_CHROMS
+    else:
+        cursor.execute('select distinct ' + chrom_col + ' from ' + table + ';')
+        chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+    entry = {'chrom_col': chrom_col, 'start_col': start_col,
+        'end_col': end_col, 'columns': None, 'chroms': {}}
+    for chrom in chroms:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            if (chrom_col is None):
+                cursor.execute('select * from ' + table + chrom + ';')
+            else:
+                cursor.execute('select * from ' + table + ' where ' +
+                    chrom_col + '=%s;', (chrom,))
+        except pymysql.err.ProgrammingError as e:
+            print(f"Skipping {table}{chrom}: {e}")
+            continue
+
+        names = [str(d[0]) for d in cursor.description]
+        columns = [[] for n in names]
+        for row in cursor:
+            for i in range(0, len(row)):
+                columns[i].append(row[i])
+        cursor.close()
+        if (len(columns[0]) == 0):
+            continue
+
+        dirname = str(len(entry['chroms']))
+        kinds = writeChrom(os.path.join(root, table, dirname), names,
+            columns, start_col, end_col)
+        entry['columns'] = names
+        entry['chroms'][chrom] = {'dir': dirname, 'rows': len(columns[0]),
+            'kinds': kinds}
+        print(f"{table} {chrom}: {len(columns[0])} rows")
+
+    return entry
+
+
+"""Builds a snapshot of the given tables (default: all) under root
+   The files are written next to root and moved into place at the end, so
+   a running annotator never sees a half-written snapshot.
+"""
+def build(root, tables=None, conn=None):
+    if (conn is None):
+        with u.pooled_connection() as conn:
+            return build(root, tables=tables, conn=conn)
+
+    root = os.path.abspath(root)
+    partial = root + '.partial'
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+
+    manifest = {'version': time.strftime('%Y%m%d%H%M%S'), 'tables': {}}
+    for table in (tables or sorted(TABLES)):
+        manifest['tables'][table] = buildTable(conn, partial, table)
+
+    fh = open(os.path.join(partial, MANIFEST), 'w')
+    json.dump(manifest, fh, indent=2)
+    fh.close()
+
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.rename(partial, root)
+    return manifest
+
+
+"""Rows of one chromosome, materialized on access from the mapped columns
+   and projected onto the selected column indices
+"""
+class SnapshotRows(object):
+    def __init__(self, path, kinds, select):
+        self.kinds = kinds
+        self.select = select
+        self.cols = {}
+        for i in select:
+            self.cols[i] = np.load(os.path.join(path, 'col' + str(i) + '.npy'),
+                mmap_mode='r')
+        self.heap = np.load(os.path.join(path, 'strings.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'),
+            mmap_mode='r')
+
+    def value(self, col, row):
+        kind = self.kinds[col]
+        v = self.cols[col][row]
+        if (kind == 'int'):
+            return int(v)
+        if (kind == 'float'):
+            return float(v)
+        if (v < 0):
+            return None
+        data = self.heap[self.offsets[v]:self.offsets[v + 1]].tobytes()
+        if (kind == 'bytes'):
+            return data
+        return data.decode('utf-8')
+
+    def __getitem__(self, row):
+        return tuple([self.value(col, row) for col in self.select])
+
+
+"""Overlap lookups over one snapshot table, with the same interface as
+   IntervalIndex. The chromosome and interval columns were fixed when the
+   snapshot was built; columns selects the columns returned (as in a
+   select list).
+"""
+class SnapshotIndex(object):
+    def __init__(self, root, table, entry, columns='*'):
+        self.root = root
+        self.table = table
+        self.entry = entry
+        names = entry['columns'] or []
+        if (columns == '*'):
+            self.select = list(range(0, len(names)))
+        else:
+            self.select = [names.index(c.strip()) for c in columns.split(',')]
+        self.names = [names[i] for i in self.select]
+        self.chroms = {}
+
+    def load(self, chrom):
+        info = self.entry['chroms'].get(str(chrom))
+        if (info is None):
+            empty = np.zeros(0, dtype=np.int64)
+            intervals = ChromIntervals([], empty, empty, empty, empty)
+        else:
+            path = os.path.join(self.root, self.table, info['dir'])
+            arrays = [np.load(os.path.join(path, a + '.npy'), mmap_mode='r')
+                for a in ['order', 'starts', 'ends', 'maxends']]
+            rows = SnapshotRows(path, info['kinds'], self.select)
+            intervals = ChromIntervals(rows, arrays[1], arrays[2],
+                order=arrays[0], maxends=arrays[3])
+        self.chroms[chrom] = intervals
+        return intervals
+
+    def get(self, chrom):
+        intervals = self.chroms.get(chrom)
+        if (intervals is None):
+            intervals = self.load(chrom)
+        return intervals
+
+    """All rows overlapping pos (or [pos, end]), like cursor.fetchall()
+    """
+    def overlapping(self, chrom, pos, end=None):
+        intervals = self.get(chrom)
+        if (end is not None):
+            end = int(end)
+        return [intervals.rows[i] for i in
+            intervals.overlapping(int(pos), end)]
+
+    """First row overlapping pos or None, like cursor.fetchone()
+    """
+    def first(self, chrom, pos):
+        intervals = self.get(chrom)
+        hits = intervals.overlapping(int(pos))
+        if (len(hits) > 0):
+            return intervals.rows[hits[0]]
+        return None
+
+    def close(self):
+        self.chroms = {}
+
+
+"""A snapshot directory written by build()
+   Files are opened with mmap, so the pages are loaded on demand and
+   shared through the OS page cache by every process reading the snapshot.
+"""
+class Snapshot(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        fh = open(os.path.join(self.root, MANIFEST))
+        self.manifest = json.load(fh)
+        fh.close()
+        self.version = self.manifest['version']
+
+    """Column names of a table as exported (the select * order)
+    """
+    def columns(self, table):
+        entry = self.manifest['tables'].get(table)
+        if (entry is None):
+            raise KeyError(f"{table} is not in the snapshot at {self.root}")
+        return entry['columns'] or []
+
+    """Returns a SnapshotIndex over table; other keyword arguments (the
+       IntervalIndex column names) are accepted and ignored
+    """
+    def index(self, table, columns='*', **kwargs):
+        entry = self.manifest['tables'].get(table)
+        if (entry is None):
+            raise KeyError(f"{table} is not in the snapshot at {self.root}")
+        return SnapshotIndex(self.root, table, entry, columns=columns)
+
+
+_snapshots = {}
+
+"""Returns the Snapshot at root, opened once per process
+"""
+def open_snapshot(root):
+    snapshot = _snapshots.get(root)
+    if (snapshot is None):
+        snapshot = Snapshot(root)
+        _snapshots[root] = snapshot
+    return snapshot
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("Usage: python snapshot.py <snapshot dir> [table ...]")
+        sys.exit(1)
+    manifest = build(sys.argv[1], tables=sys.argv[2:] or None)
+    print(f"Snapshot {manifest['version']} written to {sys.argv[1]}")
+
+### EOF
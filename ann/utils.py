@@ -13,39 +13,144 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
+from contextlib import contextmanager
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+# MySQL error raised when the credentials are rejected
+ER_ACCESS_DENIED = 1045
+
+"""Hands out connections to the reference database
+   The RDS secret is fetched from Secrets Manager at most once per ttl
+   seconds and released connections are kept in a small pool; a pooled
+   connection is pinged (and reconnected if needed) before it is reused.
+"""
+class ConnectionManager(object):
+    def __init__(self, secret_id='rds/anntools_database', 
+        database='annotator', ttl=3600, pool_size=4):
+        self.secret_id = secret_id
+        self.database = database
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.secret = None
+        self.secret_time = 0
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get_secret(self, refresh=False):
+        with self.lock:
+            if (refresh or self.secret is None or 
+                time.time() - self.secret_time > self.ttl):
+                AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                    ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+                # Get RDS secret from AWS Secrets Manager
+                asm = boto3.client('secretsmanager', 
+                    region_name=AWS_REGION_NAME)
+                try:
+                    asm_response = asm.get_secret_value(SecretId=self.secret_id)
+                    self.secret = json.loads(asm_response['SecretString'])
+                    self.secret_time = time.time()
+                except ClientError as e:
+                    print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                    raise e
+            return self.secret
+
+    """Opens a new connection; if the cached credentials are rejected
+       (e.g. the secret was rotated) the secret is refetched once
+    """
+    def connect(self):
+        try:
+            return self._connect(self.get_secret())
+        except pymysql.err.OperationalError as e:
+            if (e.args[0] != ER_ACCESS_DENIED):
+                raise e
+            return self._connect(self.get_secret(refresh=True))
+
+    def _connect(self, rds_secret):
+        # Return a connection to the database
+        return pymysql.connect(
+            host=rds_secret['host'],
+            port=rds_secret['port'],
+            user=rds_secret['username'],
+            passwd=rds_secret['password'],
+            db=self.database)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if (len(self.idle) > 0) else None
+            if (conn is None):
+                return self.connect()
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except pymysql.err.Error:
+                try:
+                    conn.close()
+                except pymysql.err.Error:
+                    pass
+
+    def release(self, conn):
+        with self.lock:
+            if (conn.open and len(self.idle) < self.pool_size):
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+
+_manager = None
+
+"""Process-wide connection manager
+"""
+def get_connection_manager():
+    global _manager
+    if (_manager is None):
+        _manager = ConnectionManager(
+            ttl=int(os.environ.get('ANN_DB_SECRET_TTL', 3600)),
+            pool_size=int(os.environ.get('ANN_DB_POOL_SIZE', 4)))
+    return _manager
+
+
+"""Forked children must not reuse the parent's pooled connections (the
+   sockets are shared with the parent), so they start with a new manager
+"""
+def _reset_connection_manager():
+    global _manager
+    _manager = None
+
+os.register_at_fork(after_in_child=_reset_connection_manager)
+
+
 """Get connection to reference database
+   The caller owns the connection and must close it
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    return get_connection_manager().connect()
+
+
+"""Borrow a pooled connection to the reference database for a with block
+"""
+def pooled_connection():
+    return get_connection_manager().connection()
 
 
 """Column inices for pileup and VCF
@@ -98,6 +203,63 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
+"""Batch version of isBetween
+   Arguments are NumPy arrays (or scalars) that broadcast against each
+   other, e.g. the positions of a block of variants against their
+   transcripts. The result is an array with the values isBetween returns
+   element by element.
+"""
+def isBetweenBatch(testStarts, refStarts, refEnds):
+    return (refStarts <= testStarts) & (testStarts <= refEnds)
+
+
+"""UCSC binning scheme (as in the bin column of the UCSC tables): five
+   levels of bins of 128kb, 1Mb, 8Mb, 64Mb and 512Mb, smallest first
+"""
+binOffsets = [512+64+8+1, 64+8+1, 8+1, 1, 0]
+binFirstShift = 17
+binNextShift = 3
+
+
+"""Smallest bin that fully contains the half-open range [start, end)
+"""
+def binFromRange(start, end):
+    startBin = start >> binFirstShift
+    endBin = (end - 1) >> binFirstShift
+    for offset in binOffsets:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> binNextShift
+        endBin = endBin >> binNextShift
+    return 0
+
+
+"""Every bin a feature overlapping the half-open range [start, end) can
+   be stored in
+"""
+def binsForRange(start, end):
+    start = max(0, start)
+    end = max(start + 1, end)
+    bins = []
+    startBin = start >> binFirstShift
+    endBin = (end - 1) >> binFirstShift
+    for offset in binOffsets:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> binNextShift
+        endBin = endBin >> binNextShift
+    return bins
+
+
+"""SQL predicate restricting a range query on [start, end] (the inclusive
+   comparisons used by the annotator, so the bins of [start - 1, end + 1)
+   are included) to the bins that can hold a match. Lets MySQL use a
+   (chrom, bin) index instead of scanning the chromosome.
+"""
+def binPredicate(start, end, column='bin'):
+    bins = binsForRange(int(start) - 1, int(end) + 1)
+    return column + ' IN (' + ','.join([str(b) for b in bins]) + ')'
+
+
 """Helper method to deduplicate the list
 """
 def dedup(mylist):
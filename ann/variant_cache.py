@@ -0,0 +1,207 @@
+# variant_cache.py
+#
+# Persistent, host-wide cache of annotated variants
+#
+# Copyright (C) 2011-2022 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+"""Caches what the stages did to a variant, across jobs
+   Entries are keyed by the normalized variant (chromosome without 'chr',
+   position, ref, alt), whether INFO was empty ('.') and a version string
+   that covers the reference data and the stage configuration. An entry
+   holds the columns the stages rewrote (INFO as the fragment appended to
+   the input INFO) and each stage's counter increments, so a hit rebuilds
+   the record and the counters without touching the database.
+   Entries live in a SQLite file shared by every job on the host, with an
+   in-process LRU in front; the least recently used entries are evicted
+   once the file holds more than max_bytes of entries.
+"""
+class VariantCache(object):
+    def __init__(self, path, version, inds, rewrites=[7],
+        max_bytes=1024*1024*1024, lru_size=100000):
+        self.path = path
+        self.version = hashlib.sha1(version.encode('utf-8')).hexdigest()[:16]
+        self.inds = inds
+        self.rewrites = sorted(set(rewrites))
+        self.max_bytes = max_bytes
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.pending = []
+        self.touched = []
+        self.counts = dict.fromkeys(['hits', 'misses', 'bypassed'], 0)
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('pragma journal_mode=wal;')
+        self.db.execute('create table if not exists variants (' + \
+            'key text primary key, value text not null, ' + \
+            'size integer not null, atime real not null);')
+        self.db.execute('create index if not exists variants_atime ' + \
+            'on variants (atime);')
+        self.db.commit()
+        self.size = self.db.execute(
+            'select coalesce(sum(size), 0) from variants;').fetchone()[0]
+
+    """Cache key for a record, or None if the record has to be annotated
+       (INFO that a stage would parse or that changes how fragments are
+       joined: leading '.', trailing ';', an existing positionType)
+    """
+    def key(self, fields):
+        if (len(fields) < 8 or len(fields) <= max(self.inds)):
+            return None
+        info = fields[7].strip()
+        if (info == '.'):
+            kind = 'dot'
+        elif (info.startswith('.') or info.endswith(';') or
+            'positionType' in info):
+            return None
+        else:
+            kind = 'info'
+
+        chr = fields[self.inds[0]].strip().replace('chr', '')
+        return '\t'.join([self.version, chr, fields[self.inds[1]].strip(),
+            fields[self.inds[2]].strip(), fields[self.inds[3]].strip(), kind])
+
+    def get(self, key):
+        if (key is None):
+            self.counts['bypassed'] += 1
+            return None
+
+        entry = self.lru.get(key)
+        if (entry is not None):
+            self.lru.move_to_end(key)
+        else:
+            row = self.db.execute('select value from variants where key=?;',
+                (key,)).fetchone()
+            if (row is not None):
+                entry = json.loads(row[0])
+                self.remember(key, entry)
+                self.touched.append(key)
+
+        if (entry is None):
+            self.counts['misses'] += 1
+        else:
+            self.counts['hits'] += 1
+        return entry
+
+    def remember(self, key, entry):
+        self.lru[key] = entry
+        if (len(self.lru) > self.lru_size):
+            self.lru.popitem(last=False)
+
+    """Rebuilds the annotated record from the input record and an entry
+    """
+    def rebuild(self, fields, entry):
+        out = list(fields)
+        for col, value in entry['fields']:
+            if (col == 7 and out[7].strip() != '.'):
+                out[7] = out[7] + value
+            else:
+                out[col] = value
+        if (entry['spaced']):
+            out = out[:1] + [' ' + f for f in out[1:]]
+        return out
+
+    """Stores what the stages did to a record (fields in, fields out and
+       the counter increments of every stage). Records the entry cannot
+       reproduce exactly are not cached.
+    """
+    def put(self, key, fields, out, counts):
+        if (key is None or len(out) != len(fields)):
+            return
+
+        spaced = (len(out) > 1 and out[1] == ' ' + fields[1])
+        stripped = [f[1:] for f in out[1:]] if (spaced) else out[1:]
+        stripped = out[:1] + stripped
+
+        values = []
+        for col in self.rewrites:
+            value = stripped[col]
+            if (col == 7 and fields[7].strip() != '.'):
+                if not value.startswith(fields[7]):
+                    return
+                value = value[len(fields[7]):]
+            values.append([col, value])
+
+        entry = {'fields': values, 'spaced': spaced, 'counts': counts}
+        if (self.rebuild(fields, entry) != out):
+            return
+
+        self.remember(key, entry)
+        self.pending.append((key, json.dumps(entry, separators=(',', ':'))))
+
+    """Writes new entries and access times, then evicts if over max_bytes
+    """
+    def flush(self):
+        now = time.time()
+        if (len(self.pending) > 0):
+            rows = [(key, value, len(key) + len(value), now)
+                for key, value in self.pending]
+            self.db.executemany('insert or replace into variants ' + \
+                '(key, value, size, atime) values (?, ?, ?, ?);', rows)
+            self.size = self.size + sum([r[2] for r in rows])
+        if (len(self.touched) > 0):
+            self.db.executemany('update variants set atime=? where key=?;',
+                [(now, key) for key in self.touched])
+        self.db.commit()
+        self.pending = []
+        self.touched = []
+
+        if (self.size > self.max_bytes):
+            self.evict()
+
+    """Drops least recently used entries until the cache is at 90% of
+       max_bytes (other processes write to the same file, so the size is
+       recounted first)
+    """
+    def evict(self):
+        self.size = self.db.execute(
+            'select coalesce(sum(size), 0) from variants;').fetchone()[0]
+        excess = self.size - int(self.max_bytes * 0.9)
+        if (excess <= 0):
+            return
+
+        victims = []
+        freed = 0
+        for key, size in self.db.execute(
+            'select key, size from variants order by atime;'):
+            victims.append((key,))
+            freed = freed + size
+            if (freed >= excess):
+                break
+        self.db.executemany('delete from variants where key=?;', victims)
+        self.db.commit()
+        self.size = self.size - freed
+        for key, in victims:
+            self.lru.pop(key, None)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def writeLog(self, fh_log):
+        writeCacheLog(fh_log, self.counts)
+
+
+"""Writes the hit and miss rates of a cache (or of several merged) to the
+   job's count log
+"""
+def writeCacheLog(fh_log, counts):
+    lookups = counts['hits'] + counts['misses']
+    ratio = (counts['hits'] / float(lookups)) * 100 if (lookups > 0) else 0.0
+    fh_log.write(f"Variant cache: {str(counts['hits'])} hits, " + \
+        f"{str(counts['misses'])} misses ({str(ratio)}% hit rate), " + \
+        f"{str(counts['bypassed'])} not cacheable\n")
+
+### EOF
@@ -29,6 +29,7 @@ config.read('archive_script_config.ini')
 region = config['aws']['AwsRegionName']
 valt_name = config['glacier']['VAULT_NAME']
 wait_time = config['sqs']['WAIT_TIME_SECONDS']
+max_messages = config.getint('sqs', 'MAX_MESSAGES', fallback=10)
 sqs_archive_url = config['sqs']['SQS_ARCHIVE_URL']
 
 '''Capstone - Exercise 7
@@ -39,44 +40,31 @@ def handle_archive_queue(sqs=None):
     print('Error: sqs handler is empty')
     return
 
-  # Read a message from the queue
-  try:
-    resp = sqs.receive_message(
-      QueueUrl=sqs_archive_url,
-      WaitTimeSeconds=20
-    )
-  except ClientError as e:
-    print(f'Fail to receive messages from sqs: {e}')
-    return
+  # Read a batch of messages from the queue, process them concurrently
+  # and delete the processed ones in one request
+  helpers.consume_messages(sqs, sqs_archive_url, handle_archive_message,
+    wait_time=wait_time, max_messages=max_messages)
 
-  resp = jmespath.search('Messages[*].{handle: ReceiptHandle, body: Body}', resp)
-  if resp is None:
-    return
-  for message in resp:
-    try:
-      data = json.loads(message['body'])
-      data = json.loads(data['Message'])
-      data = json.loads(data['notification']['message'])
-    except json.decoder.JSONDecodeError as e:
-      print(f'Fail to decode message: {message["body"]} {e}')
-      continue
-    # process message
+"""Process one archive request; True once the message can be deleted
+"""
+def handle_archive_message(message):
+  try:
+    data = json.loads(message['body'])
+    data = json.loads(data['Message'])
+    data = json.loads(data['notification']['message'])
+  except json.decoder.JSONDecodeError as e:
+    print(f'Fail to decode message: {message["body"]} {e}')
+    return False
+  # process message
 
-    print(f"The data is {data}")
-    user_id = data['user_id']
-    if not is_free_user(user_id):
-      print('It is a premium user')
-    else:
-      print('It is a free user')
-      archive(data['bucket'], data['filename'], data['job_id'])
-    # delete message
-    try:
-      response = sqs.delete_message(
-          QueueUrl=sqs_archive_url,
-          ReceiptHandle=message['handle']
-      )
-    except ClientError as e:
-      print(f'Fail to delete the message from sqs: {e}')  
+  print(f"The data is {data}")
+  user_id = data['user_id']
+  if not is_free_user(user_id):
+    print('It is a premium user')
+  else:
+    print('It is a free user')
+    archive(data['bucket'], data['filename'], data['job_id'])
+  return True
 
 def archive(bucket, filename, job_id):
   # download file from s3
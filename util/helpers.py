@@ -11,6 +11,8 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import json
 import boto3
+import jmespath
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
 # Get util configuration
@@ -76,4 +78,94 @@ def get_user_profile(id=None, db_name=None):
   # Return user profile record as a dict
   return profile
 
+
+# SQS accepts at most 10 messages per receive and per batch request
+SQS_MAX_BATCH = 10
+
+"""Receive up to max_messages messages from an SQS queue (long polling)
+Returns a list of {'handle', 'body'} (empty if nothing was received)
+"""
+def receive_messages(sqs, queue_url, wait_time=20, max_messages=SQS_MAX_BATCH):
+  try:
+    resp = sqs.receive_message(
+      QueueUrl=queue_url,
+      WaitTimeSeconds=int(wait_time),
+      MaxNumberOfMessages=max(1, min(int(max_messages), SQS_MAX_BATCH))
+    )
+  except ClientError as e:
+    print(f'Fail to receive messages from sqs: {e}')
+    return []
+  return jmespath.search(
+    'Messages[*].{handle: ReceiptHandle, body: Body}', resp) or []
+
+
+"""Delete messages by receipt handle with delete_message_batch
+Entries that fail through no fault of the request are retried once.
+Returns the handles that could not be deleted (they will be delivered
+again once their visibility timeout expires).
+"""
+def delete_messages(sqs, queue_url, handles):
+  return _batch_messages(sqs.delete_message_batch, queue_url, handles, {})
+
+
+"""Make messages visible again right away (e.g. work this consumer could
+not take), batched like delete_messages()
+"""
+def release_messages(sqs, queue_url, handles):
+  return _batch_messages(sqs.change_message_visibility_batch, queue_url,
+    handles, {'VisibilityTimeout': 0})
+
+
+def _batch_messages(request, queue_url, handles, fields, retry=True):
+  failed = []
+  for i in range(0, len(handles), SQS_MAX_BATCH):
+    chunk = handles[i:i + SQS_MAX_BATCH]
+    entries = [dict(Id=str(j), ReceiptHandle=chunk[j], **fields)
+      for j in range(len(chunk))]
+    try:
+      resp = request(QueueUrl=queue_url, Entries=entries)
+    except ClientError as e:
+      print(f'Fail to send batch request to sqs: {e}')
+      failed.extend(chunk)
+      continue
+    retries = []
+    for entry in resp.get('Failed', []):
+      print(f"Fail to handle message {entry['Id']} in sqs batch: "
+        f"{entry.get('Code')} {entry.get('Message', '')}")
+      if retry and not entry.get('SenderFault', False):
+        retries.append(chunk[int(entry['Id'])])
+      else:
+        failed.append(chunk[int(entry['Id'])])
+    if retries:
+      failed.extend(_batch_messages(request, queue_url, retries, fields,
+        retry=False))
+  return failed
+
+
+"""Receive a batch of messages, process them concurrently and delete the
+ones handled
+handler(message) gets {'handle', 'body'} and returns True if the message
+is done with; messages it returns False for (or raises on) stay in the
+queue and are delivered again. Returns the number of messages received.
+"""
+def consume_messages(sqs, queue_url, handler, wait_time=20,
+  max_messages=SQS_MAX_BATCH):
+  messages = receive_messages(sqs, queue_url, wait_time=wait_time,
+    max_messages=max_messages)
+  if len(messages) == 0:
+    return 0
+
+  def handle(message):
+    try:
+      return bool(handler(message))
+    except Exception as e:
+      print(f'Fail to process message {message["body"]}: {e}')
+      return False
+
+  with ThreadPoolExecutor(max_workers=len(messages)) as pool:
+    done = list(pool.map(handle, messages))
+  delete_messages(sqs, queue_url,
+    [messages[i]['handle'] for i in range(len(messages)) if done[i]])
+  return len(messages)
+
 ### EOF
\ No newline at end of file
@@ -34,68 +34,55 @@ def handle_results_queue(sqs=None):
   queue_url = config['sqs']['SqsUrl']
   if sqs is None:
     sqs = boto3.client('sqs', region_name=region)
-  # Read a message from the queue
-  try:
-    response = sqs.receive_message(
-         QueueUrl=queue_url,
-         WaitTimeSeconds=20 
-      )
-  except ClientError as e:
-      print(f'Fail to receive message from sqs: {e}')
-      return
-
-  response = jmespath.search('Messages[*].{handle: ReceiptHandle, body: Body}', response)
-  if response is None:
-      return
-
-  for message in response:
-      try:
-          data = json.loads(message['body'])
-          data = json.loads(data['Message'])
-      except json.decoder.JSONDecodeError as e:
-          print(f'Fail to decode message: {message["body"]} {e}')
-          continue
-      # Process message
-      if 'job_id' not in data or 'user_id' not in data or \
-              'complete_time' not in data:
-          print(f'Invalid message ')
-          continue
-      print(data)
-      job_id = data['job_id']
-      user_id = data['user_id']
-      print(f"user_id:{user_id}")
-      complete_time = parse_timestamp(data['complete_time'])
-
-      link = f"{config['gas']['GasAnnotation']}/{job_id}"
+  # Read a batch of messages from the queue, send the emails concurrently
+  # and delete the processed messages in one request
+  helpers.consume_messages(sqs, queue_url, handle_results_message,
+      wait_time=20,
+      max_messages=config.getint('sqs', 'MaxMessages', fallback=10))
 
-      subject = config['email']['Subject'] % job_id
-      body = config['email']['Body'] % (complete_time, link)
 
-      try:
-          user_profile = {}
-          user_profile = helpers.get_user_profile(user_id,)
-          if user_profile == {}:
-            print('User profile is not found')
-            continue
-          print(user_profile)
-          helpers.send_email_ses(
-              recipients=user_profile['email'],
-              subject=subject,
-              body=body
-          )
-      except Exception as e:
-          print(f'Fail to get user profile or send email: {e}')
-          print(user_profile)
-
-      # Delete message
-      try:
-          response = sqs.delete_message(
-              QueueUrl=queue_url,
-              ReceiptHandle=message['handle']
-          )
-      except ClientError as e:
-          print(f'Fail to delete message from sqs: {e}')
+"""Email the user about one completed job; True once the message can be
+deleted
+"""
+def handle_results_message(message):
+  try:
+      data = json.loads(message['body'])
+      data = json.loads(data['Message'])
+  except json.decoder.JSONDecodeError as e:
+      print(f'Fail to decode message: {message["body"]} {e}')
+      return False
+  # Process message
+  if 'job_id' not in data or 'user_id' not in data or \
+          'complete_time' not in data:
+      print(f'Invalid message ')
+      return False
+  print(data)
+  job_id = data['job_id']
+  user_id = data['user_id']
+  print(f"user_id:{user_id}")
+  complete_time = parse_timestamp(data['complete_time'])
+
+  link = f"{config['gas']['GasAnnotation']}/{job_id}"
+
+  subject = config['email']['Subject'] % job_id
+  body = config['email']['Body'] % (complete_time, link)
 
+  try:
+      user_profile = {}
+      user_profile = helpers.get_user_profile(user_id,)
+      if user_profile == {}:
+        print('User profile is not found')
+        return False
+      print(user_profile)
+      helpers.send_email_ses(
+          recipients=user_profile['email'],
+          subject=subject,
+          body=body
+      )
+  except Exception as e:
+      print(f'Fail to get user profile or send email: {e}')
+      print(user_profile)
+  return True
 
 
 def parse_timestamp(ts):
@@ -15,6 +15,10 @@ import json
 import jmespath
 from botocore.exceptions import ClientError
 
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+
 # Get configuration
 from configparser import ConfigParser
 config = ConfigParser(os.environ)
@@ -24,6 +28,7 @@ region = config['aws']['AwsRegionName']
 valt_name = config['glacier']['VaultName']
 sqs_thaw_url = config['sqs']['SQSThawUrl']
 wait_time = config['sqs']['WaitTimeSeconds']
+max_messages = config.getint('sqs', 'MaxMessages', fallback=10)
 job_restore_topic = config['sns']['JobRestoreTopic']
 
 glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
@@ -39,40 +44,28 @@ def handle_thaw_queue(sqs=None):
   if sqs is None:
     print('The SQS is None')
     return
-  # Read a message from the queue
-  try:
-    resp = sqs.receive_message(
-        QueueUrl=sqs_thaw_url,
-        WaitTimeSeconds=int(wait_time)
-    )
-  except ClientError as e:
-    print(f'Fail to retrieve message from sqs:{e}')
-  # Process message
-  resp = jmespath.search('Messages[*].{handle: ReceiptHandle, body: Body}', resp)
-  if resp is None:
-    return
-  for message in resp:
-    try:
-      data = json.loads(message['body'])
-      data = json.loads(data['Message'])
-    except json.decoder.JSONDecodeError as e:
-      print(f'Fail to decode message: {message["body"]} {e}')
-      continue
-
-    if 'archive_id' in data and 'job_id' in data:
-      archive_id = data['archive_id']
-      job_id = data['job_id']
-      retrieve_obj(job_id, archive_id)
-    else:
-      print(f'Invalid message{data}')
-  # Delete message
+  # Read a batch of messages from the queue, process them concurrently
+  # and delete the processed ones in one request
+  helpers.consume_messages(sqs, sqs_thaw_url, handle_thaw_message,
+    wait_time=wait_time, max_messages=max_messages)
+
+"""Process one thaw request; True once the message can be deleted
+"""
+def handle_thaw_message(message):
   try:
-    sqs.delete_message(
-        QueueUrl=sqs_thaw_url,
-        ReceiptHandle=message['handle']
-    )
-  except ClientError as e:
-    print(f'Unable to delete message from sqs: {e}')
+    data = json.loads(message['body'])
+    data = json.loads(data['Message'])
+  except json.decoder.JSONDecodeError as e:
+    print(f'Fail to decode message: {message["body"]} {e}')
+    return False
+
+  if 'archive_id' in data and 'job_id' in data:
+    archive_id = data['archive_id']
+    job_id = data['job_id']
+    retrieve_obj(job_id, archive_id)
+  else:
+    print(f'Invalid message{data}')
+  return True
 
 def retrieve_obj(job_id, archive_id):
   print(f'Retrieve job {job_id}, archive_id:{archive_id}')